@@ -1,27 +1,76 @@
 import sys
 import os
+import copy
 import argparse
-from .create import CreateMods, CreateDownloads, Overwrite
-from .conflict import Conflict
-from .tree import Tree
-from .devbuild import DevBuild
-from .context import Context, Dump
+import importlib
+from .context import Context
+from .blobs import LINK_MODES
+from .archivers import ARCHIVERS
+from . import log
 from .log import *
 
-MO_BASE_DIR = os.path.join(os.getenv("LOCALAPPDATA"), "ModOrganizer")
 DEFAULT_INSTANCE = "mo-test"
-DEFAULT_INSTANCE_DIR = os.path.join(MO_BASE_DIR, DEFAULT_INSTANCE)
+
+# name, module, class and help of every command; a command's module is only
+# imported when it's selected, the help is shown in the list of commands
+COMMANDS = [
+    ("mods", "create", "CreateMods", "creates mods with files in each"),
+    ("dls", "create", "CreateDownloads", "creates dummy downloads"),
+    ("overwrite", "create", "Overwrite",
+        "creates files in the overwrite directory"),
+    ("conflict", "conflict", "Conflict",
+        "creates mods with conflicting files"),
+    ("tree", "tree", "Tree", "creates mods with a file tree"),
+    ("filelists", "filelists", "FileLists",
+        "creates mods with deep trees of uniquely named files"),
+    ("scenario", "scenario", "Scenario",
+        "creates mods described in a scenario file"),
+    ("vfs", "vfs", "Vfs",
+        "builds the virtual file tree of the mods directory"),
+    ("devbuild", "devbuild", "DevBuild", "creates dev builds"),
+    ("bench", "bench", "Bench", "measures how fast the generators are"),
+    ("dump", "context", "Dump", "dumps all settings used by this script")]
+
+# commands that don't use the instance, their context isn't validated
+STANDALONE_COMMANDS = ["bench"]
+
+def mo_base_dir():
+    # None if LOCALAPPDATA isn't set, like on linux
+    appdata = os.getenv("LOCALAPPDATA")
+    if appdata is None:
+        return None
+
+    return os.path.join(appdata, "ModOrganizer")
+
+def load_command(name):
+    for n, module, cls, help in COMMANDS:
+        if n == name:
+            m = importlib.import_module("." + module, __package__)
+            return getattr(m, cls)()
+
+    return None
 
 def main_parser():
     p = argparse.ArgumentParser(
         description="==> IMPORTANT: all commands below might empty the " +
                     "mods or downloads directories of the given instance " +
-                    "(defaults to " + DEFAULT_INSTANCE_DIR + ")")
+                    "(defaults to $LOCALAPPDATA/ModOrganizer/" +
+                    DEFAULT_INSTANCE + ")")
 
     p.add_argument(
         "--dry",
         action="store_true",
-        help="simulates all filesystem operations")
+        help="simulates all filesystem operations and reports what would " +
+             "be written instead: files, directories, bytes, archives, " +
+             "cleared entries, free space and inodes, and a projected " +
+             "duration from a short calibration write on the target " +
+             "filesystem; use --log 4 to see every operation")
+
+    p.add_argument(
+        "--plan",
+        action="store_true",
+        help="runs the command dry first and stops before writing " +
+             "anything if there isn't enough free space or inodes for it")
 
     p.add_argument(
         "--log",
@@ -30,18 +79,105 @@ def main_parser():
         help="logs up to the given level: 0=none, 1=error, 2=warn, 3=info, "
              "4=operations, defaults to info")
 
+    p.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of worker processes used by commands that create " +
+             "multiple mods or downloads, defaults to 1")
+
+    p.add_argument(
+        "--link-mode",
+        type=str,
+        choices=LINK_MODES,
+        default="copy",
+        help="how generated files are created: 'copy' writes every file, " +
+             "the others write each distinct content once in " +
+             "$instance/modutils-blobs/ and link files to it, defaults " +
+             "to 'copy'")
+
+    p.add_argument(
+        "--incremental",
+        action="store_true",
+        help="instead of clearing directories, only creates, rewrites or " +
+             "deletes the files that changed since the last run, based on " +
+             "the manifest in the instance directory; does nothing if the " +
+             "command and arguments are the same as the last run; the " +
+             "manifest is only written by incremental runs, so the first " +
+             "one generates everything")
+
+    p.add_argument(
+        "--trash",
+        type=str,
+        choices=["wait", "detach"],
+        default="wait",
+        help="cleared directories are emptied in the background while " +
+             "files are generated; 'wait' waits for the deletion to finish " +
+             "before exiting, 'detach' leaves it to a background process, " +
+             "defaults to 'wait'")
+
+    p.add_argument(
+        "--archiver",
+        type=str,
+        choices=ARCHIVERS,
+        default="auto",
+        help="how archives are created: '7z' runs 7z for each archive, " +
+             "'python' creates them in-process with zipfile and tarfile, " +
+             "'auto' uses 7z if it can be found, python otherwise, " +
+             "defaults to 'auto'")
+
+    p.add_argument(
+        "--archive-jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="number of archives created at the same time by each worker " +
+             "process, defaults to the number of cpus")
+
+    p.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="overlaps directory creation, file writes and archiving " +
+             "across batches with asyncio, up to --async-limit operations " +
+             "at the same time")
+
+    p.add_argument(
+        "--async-limit",
+        type=int,
+        default=64,
+        help="maximum number of operations in flight with --async, " +
+             "defaults to 64")
+
+    p.add_argument(
+        "--profile",
+        type=str,
+        metavar="FILE",
+        default=None,
+        help="records the count, bytes and latencies of every filesystem " +
+             "operation, including worker processes, and writes them as " +
+             "json to the given file on exit")
+
+    p.add_argument(
+        "--cprofile",
+        type=str,
+        metavar="FILE",
+        default=None,
+        help="runs the command under cProfile and writes the stats to the " +
+             "given file, for use with pstats; worker processes are not " +
+             "profiled")
+
     p.add_argument(
         "--base-dir",
         type=str,
-        default=MO_BASE_DIR,
-        help="base data directory, defaults to " + MO_BASE_DIR)
+        default=None,
+        help="base data directory, defaults to $LOCALAPPDATA/ModOrganizer")
 
     p.add_argument(
         "--destination",
         type=str,
-        default=os.getcwd(),
+        default=None,
         help="destination dir given to unimake.py (contains build, install, "
-             "etc.), defaults to $pwd (currently '" + os.getcwd() + "')")
+             "etc.), defaults to $pwd")
 
     p.add_argument(
         "--instance",
@@ -60,36 +196,89 @@ def main_parser():
 
     return p
 
-def create_parser(commands):
+def create_parser(command=None, add_help=True):
+    # only the given command gets its real parser, the others are listed with
+    # their help; without help, the arguments of the commands are left for
+    # parse_known_args()
     p = main_parser()
     sp = p.add_subparsers(dest="command")
 
-    for c in commands:
-        c.create_parser(sp)
+    for name, module, cls, help in COMMANDS:
+        if command is not None and name == command.name():
+            command.create_parser(sp)
+        else:
+            sp.add_parser(name, help=help, add_help=add_help)
 
     return p
 
-def main():
-    commands = [
-        CreateMods(),
-        CreateDownloads(),
-        Overwrite(),
-        Conflict(),
-        Tree(),
-        DevBuild(),
-        Dump()]
-
-    p = create_parser(commands)
+def parse_arguments():
+    # returns (command, options), command is None if there isn't one; the
+    # command is found first so only its module is imported
+    opts, rest = create_parser(add_help=False).parse_known_args()
+
+    command = None
+    if opts.command is not None:
+        command = load_command(opts.command)
+
+    p = create_parser(command)
     opts = p.parse_args()
 
-    sel = None
-    for c in commands:
-        if opts.command == c.name():
-            sel = c
-            break
+    if command is None:
+        p.print_help()
+
+    return command, opts
+
+def resolve_defaults(opts, standalone):
+    # defaults that depend on the environment, returns False if one can't be
+    # resolved; standalone commands don't need a base directory
+    if opts.destination is None:
+        opts.destination = os.getcwd()
+
+    if opts.base_dir is None:
+        opts.base_dir = mo_base_dir()
+
+        if opts.base_dir is None and not standalone:
+            error("LOCALAPPDATA is not set, use --base-dir")
+            return False
+
+    return True
+
+def plan_run(command, opts):
+    # runs the command dry with only errors logged and logs its plan, returns
+    # False if the command failed or can't run; commands that don't generate
+    # anything have no plan and can always run
+    dry_opts = copy.copy(opts)
+    dry_opts.dry = True
+    dry_opts.profile = None
+
+    level = log.log_level
+    set_log_level(level & LogLevels.ERROR)
+
+    try:
+        cx = Context(dry_opts)
+
+        try:
+            # commands return 0 or None on success
+            try:
+                r = command.run(cx)
+            except Context.ValidationFailed:
+                return False
+
+            if r is not None and r != 0:
+                return False
+
+            plan = cx.plan()
+        finally:
+            cx.close()
+    finally:
+        set_log_level(level)
+
+    return plan is None or plan.log()
+
+def main():
+    sel, opts = parse_arguments()
 
     if sel is None:
-        p.print_help()
         return 1
 
     set_log_level(LogLevels.NONE)
@@ -98,16 +287,54 @@ def main():
     if opts.log >= 3: add_log_level(LogLevels.INFO)
     if opts.log >= 4: add_log_level(LogLevels.OPERATIONS)
 
-    if opts.dry:
-        add_log_level(LogLevels.OPERATIONS)
+    standalone = opts.command in STANDALONE_COMMANDS
+
+    if not resolve_defaults(opts, standalone):
+        return 1
 
     try:
-        cx = Context(opts)
-        return sel.run(cx)
+        if opts.plan and not opts.dry and not standalone:
+            if not plan_run(sel, opts):
+                error("not running the command")
+                return 1
+
+        cx = Context(opts, validate=not standalone)
     except Context.ValidationFailed:
-        print("validation failed, check your paths")
+        error("validation failed, check your paths")
         return 1
 
+    profiler = None
+    if opts.cprofile is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        if cx.up_to_date():
+            info("nothing changed since the last run")
+            return 0
+
+        if opts.log >= 3 and not opts.dry:
+            cx.start_progress()
+
+        r = sel.run(cx)
+        cx.finish()
+        cx.log_summary()
+        return r
+    except Context.ValidationFailed:
+        # like the archiver, which is only looked for when it's needed
+        return 1
+    finally:
+        cx.close()
+
+        if profiler is not None:
+            profiler.disable()
+            info("writing cProfile stats to {}", opts.cprofile)
+            profiler.dump_stats(opts.cprofile)
+
+        cx.write_profile()
+        flush_log()
+
 
 if __name__ == "__main__":
     exit(main())
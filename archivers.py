@@ -0,0 +1,417 @@
+import os
+import io
+import abc
+import glob
+import shutil
+import struct
+import fnmatch
+import subprocess
+from .payload import SizedContent, StreamedContent
+from .blobs import content_hash
+from .log import *
+
+SEVENZ = r"C:\Program Files\7-Zip\7z.exe"
+
+# names of the 7z executable looked up in the PATH when SEVENZ doesn't exist
+SEVENZ_NAMES = ["7z", "7zz", "7za"]
+
+# "auto" uses 7z if it can be found, python otherwise
+ARCHIVERS = ["auto", "7z", "python"]
+
+# tarfile modes for the extensions the python archiver can create, anything
+# else is a zip; longest extensions first
+TAR_MODES = [
+    (".tar.gz", "w:gz"),
+    (".tar.bz2", "w:bz2"),
+    (".tar.xz", "w:xz"),
+    (".tgz", "w:gz"),
+    (".tbz2", "w:bz2"),
+    (".txz", "w:xz"),
+    (".tar", "w")]
+
+# same level as 7z's -mx=5
+ZIP_LEVEL = 5
+
+# payloads that are not SizedContent are sent in pieces of this size
+CHUNK_SIZE = 1024 * 1024
+
+# archives with one file of at most this size are created once per payload
+# and kept in memory, see ZipTemplate
+TEMPLATE_MAX_SIZE = 16 * 1024 * 1024
+
+# zip structures used by ZipTemplate: local file header, central directory
+# file header and end of central directory record
+ZIP_LOCAL = struct.Struct("<IHHHHHIIIHH")
+ZIP_CENTRAL = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP_END = struct.Struct("<IHHHHIIH")
+ZIP_LOCAL_SIG = 0x04034b50
+ZIP_CENTRAL_SIG = 0x02014b50
+ZIP_END_SIG = 0x06054b50
+
+# general purpose flags: sizes are in a data descriptor after the data, and
+# the name is utf-8
+ZIP_DATA_DESCRIPTOR = 0x08
+ZIP_UTF8 = 0x800
+
+
+def find_7z():
+    # returns the path to the 7z executable, or None
+    if os.path.exists(SEVENZ):
+        return SEVENZ
+
+    for name in SEVENZ_NAMES:
+        path = shutil.which(name)
+        if path is not None:
+            return path
+
+    return None
+
+def payload_chunks(content):
+    # yields the bytes of the given content in pieces, without having all of
+    # it in memory for SizedContent
+    if isinstance(content, SizedContent):
+        yield from content.chunks()
+        return
+
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+
+    view = memoryview(content)
+    for i in range(0, len(view), CHUNK_SIZE):
+        yield view[i:i + CHUNK_SIZE]
+
+def make_archiver(name):
+    # returns None if the archiver is not available
+    if name == "python":
+        return PythonArchiver()
+
+    exe = find_7z()
+
+    if exe is not None:
+        return SevenZipArchiver(exe)
+    elif name == "auto":
+        return PythonArchiver()
+
+    return None
+
+
+class ZipTemplate:
+    # a zip archive with one file, where only the name of the file can change;
+    # the compressed data and its crc don't depend on the name, so the archive
+    # for any name is built from the cached pieces without compressing again
+
+    def __init__(self, central, data):
+        # central is the unpacked central directory header of the file
+        self.central_ = central
+        self.data_ = data
+
+    @staticmethod
+    def parse(archive):
+        # returns a template from the bytes of a zip with one file, or None if
+        # it can't be used, like zip64 or multiple files
+        end = archive.rfind(struct.pack("<I", ZIP_END_SIG))
+        if end < 0:
+            return None
+
+        e = ZIP_END.unpack_from(archive, end)
+        if e[4] != 1:
+            return None
+
+        c = ZIP_CENTRAL.unpack_from(archive, e[6])
+        if c[0] != ZIP_CENTRAL_SIG or 0xffffffff in (c[8], c[9], c[16]):
+            return None
+
+        local = ZIP_LOCAL.unpack_from(archive, c[16])
+        if local[0] != ZIP_LOCAL_SIG:
+            return None
+
+        start = c[16] + ZIP_LOCAL.size + local[9] + local[10]
+        return ZipTemplate(c, archive[start:start + c[8]])
+
+    def render(self, path):
+        (_, made_by, needed, flags, method, time, date, crc, csize, usize,
+            _, _, _, _, internal, external, _) = self.central_
+
+        name = path.encode("utf-8")
+
+        # sizes are in the headers, and the name may have changed encoding
+        flags &= ~(ZIP_DATA_DESCRIPTOR | ZIP_UTF8)
+        if not path.isascii():
+            flags |= ZIP_UTF8
+
+        local = ZIP_LOCAL.pack(
+            ZIP_LOCAL_SIG, needed, flags, method, time, date, crc, csize,
+            usize, len(name), 0)
+
+        central = ZIP_CENTRAL.pack(
+            ZIP_CENTRAL_SIG, made_by, needed, flags, method, time, date, crc,
+            csize, usize, len(name), 0, 0, 0, internal, external, 0)
+
+        offset = len(local) + len(name) + len(self.data_)
+        end = ZIP_END.pack(
+            ZIP_END_SIG, 0, 0, 1, 1, len(central) + len(name), offset, 0)
+
+        return b"".join([local, name, self.data_, central, name, end])
+
+
+class Archiver(metaclass=abc.ABCMeta):
+    def __init__(self):
+        # content hash -> ZipTemplate, or None for payloads that can't be
+        # templated; threads creating the same template at the same time
+        # both build it, which is harmless
+        self.templates_ = {}
+
+    @abc.abstractmethod
+    def name(self):
+        pass
+
+    @abc.abstractmethod
+    def archive(self, input, output, exclude):
+        # input is a path that can have wildcards, directories are added
+        # recursively; exclude is a list of names to skip at any level
+        pass
+
+    @abc.abstractmethod
+    def archive_string(self, path, content):
+        # returns the bytes of a zip archive with one file
+        pass
+
+    def archive_to(self, path, content, fd):
+        # writes the same archive as archive_string() to the given file
+        # descriptor; small payloads are only archived once and then reused
+        # for every name, see ZipTemplate, bigger ones are streamed
+        if len(content) > TEMPLATE_MAX_SIZE:
+            self.stream_to(path, content, fd)
+            return
+
+        t = self.template(content)
+        if t is None:
+            self.stream_to(path, content, fd)
+            return
+
+        view = memoryview(t.render(path))
+        while len(view) > 0:
+            view = view[os.write(fd, view):]
+
+    def template(self, content):
+        key = content_hash(content)
+
+        try:
+            return self.templates_[key]
+        except KeyError:
+            pass
+
+        # the name is replaced anyway
+        t = ZipTemplate.parse(self.archive_string("t", content))
+        self.templates_[key] = t
+
+        return t
+
+    @abc.abstractmethod
+    def stream_to(self, path, content, fd):
+        # like archive_to(), streaming the content in and the archive out
+        pass
+
+    @abc.abstractmethod
+    def archive_files(self, listfile, output, cwd):
+        # listfile has one path per line, relative to cwd
+        pass
+
+
+class ArchiveContent(StreamedContent):
+    # content of a file that is an archive with one file in it, created while
+    # the file is written
+
+    def __init__(self, archiver, path, payload):
+        self.archiver_ = archiver
+        self.path_ = path
+        self.payload_ = payload
+
+    def __len__(self):
+        # the size of the archive isn't known until it's written, this is the
+        # size of the payload
+        return len(self.payload_)
+
+    def description(self):
+        return "archive:{}:{}:{}".format(
+            self.archiver_.name(), self.path_, content_hash(self.payload_))
+
+    def write_to(self, fd):
+        self.archiver_.archive_to(self.path_, self.payload_, fd)
+
+
+class SevenZipArchiver(Archiver):
+    def __init__(self, exe):
+        super().__init__()
+        self.exe_ = exe
+
+    def name(self):
+        return "7z"
+
+    def archive(self, input, output, exclude):
+        args = [self.exe_, "a", output, "-r", "-mx=5", input]
+        for e in exclude:
+            args.append("-xr!" + e)
+
+        self.run(args, None)
+
+    def archive_string(self, path, content):
+        if isinstance(content, SizedContent):
+            content = content.data()
+
+        # filename doesn't matter because the archive is dumped in stdout, but
+        # the extension dictates the compression type
+        return self.popen([self.exe_, "a", "d.zip", "-si" + path, "-so"], content)
+
+    def stream_to(self, path, content, fd):
+        # 7z writes straight to the file, the content is sent in pieces
+        p = subprocess.Popen(
+            [self.exe_, "a", "d.zip", "-si" + path, "-so"],
+            stdin=subprocess.PIPE, stdout=fd)
+
+        try:
+            for chunk in payload_chunks(content):
+                p.stdin.write(chunk)
+        finally:
+            p.stdin.close()
+
+        if p.wait() != 0:
+            raise Exception(
+                "7z failed with exit code {} while archiving {}".format(
+                    p.returncode, path))
+
+    def archive_files(self, listfile, output, cwd):
+        self.run([self.exe_, "a", output, "@" + listfile], cwd)
+
+    def run(self, args, cwd):
+        subprocess.run(args, cwd=cwd)
+
+    def popen(self, args, send):
+        p = subprocess.Popen(
+            args, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+
+        out, err = p.communicate(send)
+        if err is not None:
+            error(err)
+
+        return out
+
+
+class PythonArchiver(Archiver):
+    # uses zipfile and tarfile in this process, the format is picked from
+    # the extension of the output; formats python can't create, like 7z, are
+    # written as zip, which is what archive_string() always did with 7z;
+    # zipfile and tarfile are imported by the methods that use them, so
+    # they're not loaded when 7z is used
+
+    def __init__(self):
+        super().__init__()
+
+        # extensions that were already warned about
+        self.warned_ = set()
+
+    def name(self):
+        return "python"
+
+    def archive(self, input, output, exclude):
+        entries = []
+
+        for path in sorted(glob.glob(input)):
+            base = os.path.dirname(path)
+            entries += self.walk(path, base, exclude)
+
+        self.write(output, entries)
+
+    def archive_string(self, path, content):
+        if isinstance(content, SizedContent):
+            content = content.data()
+
+        import zipfile
+
+        buffer = io.BytesIO()
+
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED, True, ZIP_LEVEL) as z:
+            z.writestr(path, content)
+
+        return buffer.getvalue()
+
+    def stream_to(self, path, content, fd):
+        import zipfile
+
+        zip64 = len(content) >= zipfile.ZIP64_LIMIT
+
+        with open(fd, "wb", closefd=False) as f:
+            with zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED, True, ZIP_LEVEL) as z:
+                with z.open(path, "w", force_zip64=zip64) as entry:
+                    for chunk in payload_chunks(content):
+                        entry.write(chunk)
+
+    def archive_files(self, listfile, output, cwd):
+        entries = []
+
+        with open(listfile, "r") as f:
+            for line in f:
+                name = line.rstrip("\n")
+                if name != "":
+                    entries.append((os.path.join(cwd, name), name))
+
+        self.write(output, entries)
+
+    def walk(self, path, base, exclude):
+        # returns (path, name in archive) for path and everything under it,
+        # skipping excluded names
+        entries = []
+        stack = [path]
+
+        while len(stack) > 0:
+            p = stack.pop()
+
+            if self.excluded(os.path.basename(p), exclude):
+                continue
+
+            entries.append((p, os.path.relpath(p, base)))
+
+            if os.path.isdir(p) and not os.path.islink(p):
+                for e in sorted(os.listdir(p), reverse=True):
+                    stack.append(os.path.join(p, e))
+
+        return entries
+
+    def excluded(self, name, exclude):
+        for e in exclude:
+            if fnmatch.fnmatch(name, e):
+                return True
+
+        return False
+
+    def write(self, output, entries):
+        import zipfile
+        import tarfile
+
+        mode = self.tar_mode(output)
+
+        if mode is not None:
+            with tarfile.open(output, mode) as t:
+                for path, name in entries:
+                    t.add(path, name, recursive=False)
+
+            return
+
+        ext = os.path.splitext(output)[1].lower()
+        if ext != ".zip" and ext not in self.warned_:
+            warn("the python archiver can't create {} files, writing zip " +
+                 "archives instead", ext)
+            self.warned_.add(ext)
+
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED, True, ZIP_LEVEL) as z:
+            for path, name in entries:
+                z.write(path, name)
+
+    def tar_mode(self, output):
+        lower = output.lower()
+
+        for ext, mode in TAR_MODES:
+            if lower.endswith(ext):
+                return mode
+
+        return None
@@ -0,0 +1,437 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+from .devbuild import FileGatherer, SOURCE_IGNORE
+from .log import *
+
+SCALES = ["small", "medium", "large"]
+
+# name -> arguments of the command for each scale, None to skip it at that
+# scale; every benchmark runs in a new process on a scratch instance, except
+# "filegatherer", which runs FileGatherer in-process on the mods created by
+# its command, which isn't timed
+BENCHMARKS = [
+    ("mods", {
+        "small":  ["mods", "20", "--files", "100"],
+        "medium": ["mods", "100", "--files", "500"],
+        "large":  ["mods", "500", "--files", "1000"]}),
+
+    ("mods-huge", {
+        "small":  None,
+        "medium": ["mods", "1", "--huge"],
+        "large":  ["mods", "4", "--huge"]}),
+
+    ("dls", {
+        "small":  ["dls", "1000"],
+        "medium": ["dls", "10000"],
+        "large":  ["dls", "50000"]}),
+
+    ("conflict", {
+        "small":  ["conflict", "--mods", "20", "--files", "1000"],
+        "medium": ["conflict", "--mods", "100", "--files", "5000"],
+        "large":  ["conflict", "--mods", "500", "--files", "10000"]}),
+
+    ("tree", {
+        "small":  ["tree", "--depth", "4", "--fanout", "6"],
+        "medium": ["tree", "--depth", "5", "--fanout", "8"],
+        "large":  ["tree", "--depth", "6", "--fanout", "8"]}),
+
+    ("filegatherer", {
+        "small":  ["tree", "--depth", "4", "--fanout", "6"],
+        "medium": ["tree", "--depth", "5", "--fanout", "8"],
+        "large":  ["tree", "--depth", "6", "--fanout", "8"]})]
+
+BENCHMARK_NAMES = [name for name, scales in BENCHMARKS]
+
+# global options passed down to the benchmarked commands
+FORWARDED_OPTIONS = [
+    ("jobs", "--jobs"),
+    ("link_mode", "--link-mode"),
+    ("archiver", "--archiver"),
+    ("archive_jobs", "--archive-jobs"),
+    ("async_limit", "--async-limit")]
+
+SCRATCH_INSTANCE = "bench"
+
+# a single run is too noisy to compare with a baseline
+DEFAULT_REPEAT = 5
+
+
+def directory_totals(path):
+    # returns (files, bytes) under the given path, iteratively
+    files = 0
+    size = 0
+    stack = [path]
+
+    while len(stack) > 0:
+        with os.scandir(stack.pop()) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                else:
+                    files += 1
+                    size += e.stat(follow_symlinks=False).st_size
+
+    return files, size
+
+def peak_rss(usage):
+    # ru_maxrss is in kilobytes, except on macos
+    if sys.platform == "darwin":
+        return usage.ru_maxrss
+
+    return usage.ru_maxrss * 1024
+
+def compare(baseline, results, threshold):
+    # returns a list of (name, baseline wall, wall, ratio, verdict) for the
+    # benchmarks in both
+    rows = []
+
+    for name in BENCHMARK_NAMES:
+        b = baseline.get(name)
+        r = results.get(name)
+
+        if b is None or r is None:
+            continue
+
+        ratio = r["wall"] / max(b["wall"], 1e-9)
+
+        if ratio > 1 + threshold:
+            verdict = "slower"
+        elif ratio < 1 - threshold:
+            verdict = "faster"
+        else:
+            verdict = "same"
+
+        rows.append((name, b["wall"], r["wall"], ratio, verdict))
+
+    return rows
+
+
+class Scratch:
+    # a temporary base directory with an instance, the minimum for a
+    # Context to validate
+
+    def __init__(self):
+        self.base_ = tempfile.mkdtemp(prefix="modutils-bench-")
+        self.instance_ = os.path.join(self.base_, SCRATCH_INSTANCE)
+        self.destination_ = os.path.join(self.base_, "destination")
+
+        with open(os.path.join(self.base_, "nxmhandler.ini"), "w") as f:
+            f.write("")
+
+        os.makedirs(self.instance_)
+        with open(os.path.join(self.instance_, "ModOrganizer.ini"), "w") as f:
+            f.write("[General]\n[Settings]\n")
+
+        for d in ["mods", "downloads", "overwrite"]:
+            os.makedirs(os.path.join(self.instance_, d))
+
+        os.makedirs(os.path.join(self.destination_, "install"))
+        os.makedirs(os.path.join(
+            self.destination_, "build", "modorganizer_super"))
+
+        # arguments of the command that created what's in the instance, so
+        # the input of filegatherer is only created once for all its runs
+        self.created_ = None
+
+    def base(self):
+        return self.base_
+
+    def instance(self):
+        return self.instance_
+
+    def empty(self):
+        # so the files counted after a benchmark are only its own
+        self.created_ = None
+
+        for d in ["mods", "downloads", "overwrite"]:
+            path = os.path.join(self.instance_, d)
+            shutil.rmtree(path)
+            os.makedirs(path)
+
+    def created(self):
+        return self.created_
+
+    def set_created(self, args):
+        self.created_ = args
+
+    def arguments(self):
+        return [
+            "--base-dir", self.base_,
+            "--instance", SCRATCH_INSTANCE,
+            "--destination", self.destination_]
+
+    def remove(self):
+        shutil.rmtree(self.base_, ignore_errors=True)
+
+
+class Bench:
+    def name(self):
+        return "bench"
+
+    def create_parser(self, sp):
+        p = sp.add_parser(
+            self.name(),
+            help="measures how fast the generators are",
+            description="runs the generators at fixed scale points in a " +
+                        "scratch instance and reports wall time, files/s, " +
+                        "bytes/s and peak memory; results can be saved as " +
+                        "a baseline and compared with later runs; global " +
+                        "options like --jobs and --archiver are passed " +
+                        "down to the generators")
+
+        p.add_argument(
+            "--scale",
+            type=str,
+            choices=SCALES,
+            default="small",
+            help="size of the benchmarks, defaults to 'small'")
+
+        p.add_argument(
+            "--only",
+            type=str,
+            nargs="+",
+            choices=BENCHMARK_NAMES,
+            metavar="NAME",
+            default=None,
+            help="runs only the given benchmarks: " +
+                 ", ".join(BENCHMARK_NAMES))
+
+        p.add_argument(
+            "--repeat",
+            type=int,
+            default=DEFAULT_REPEAT,
+            help="runs each benchmark this many times and keeps the " +
+                 "median, defaults to " + str(DEFAULT_REPEAT))
+
+        p.add_argument(
+            "--save",
+            type=str,
+            metavar="FILE",
+            default=None,
+            help="saves the results as json in the given file")
+
+        p.add_argument(
+            "--baseline",
+            type=str,
+            metavar="FILE",
+            default=None,
+            help="compares the results with a file saved by --save; " +
+                 "returns 1 if any benchmark is slower")
+
+        p.add_argument(
+            "--threshold",
+            type=float,
+            default=0.1,
+            help="wall time differences with the baseline below this " +
+                 "fraction are considered noise, defaults to 0.1")
+
+        p.add_argument(
+            "--keep",
+            action="store_true",
+            help="doesn't delete the scratch instance")
+
+        return p
+
+    def run(self, cx):
+        baseline = None
+        if cx.options.baseline is not None:
+            baseline = self.load_baseline(cx)
+            if baseline is None:
+                return 1
+
+        scratch = Scratch()
+        info("scratch instance in {}", scratch.base())
+
+        try:
+            results = self.run_all(cx, scratch)
+        finally:
+            if not cx.options.keep:
+                scratch.remove()
+
+        self.report(results)
+
+        if cx.options.save is not None:
+            self.save(cx, results)
+
+        if baseline is not None:
+            return self.compare(cx, baseline["results"], results)
+
+        return 0
+
+    def run_all(self, cx, scratch):
+        results = {}
+
+        for name, scales in BENCHMARKS:
+            args = scales[cx.options.scale]
+
+            if args is None:
+                continue
+
+            if cx.options.only is not None and name not in cx.options.only:
+                continue
+
+            runs = []
+            for i in range(max(1, cx.options.repeat)):
+                runs.append(self.run_one(cx, scratch, name, args))
+
+            # the run with the median wall time, lower median for even counts
+            runs.sort(key=lambda r: r["wall"])
+            median = runs[(len(runs) - 1) // 2]
+
+            info("{}: {:.2f}s", name, median["wall"])
+            results[name] = median
+
+        return results
+
+    def run_one(self, cx, scratch, name, args):
+        if name == "filegatherer":
+            return self.run_filegatherer(cx, scratch, args)
+
+        scratch.empty()
+        wall, rss = self.run_command(cx, scratch, name, args)
+
+        # counting what's on disk, the command's own stats aren't available
+        files = 0
+        size = 0
+        for d in ["mods", "downloads", "overwrite"]:
+            f, s = directory_totals(os.path.join(scratch.instance(), d))
+            files += f
+            size += s
+
+        return self.result(wall, files, size, rss)
+
+    def run_command(self, cx, scratch, name, args):
+        # runs the command in a new process, returns its wall time and peak
+        # memory, None if it can't be known
+        command = self.command_line(cx, scratch, args)
+        log_op("running {}", " ".join(command))
+
+        # the package is imported from its parent directory
+        env = dict(os.environ)
+        parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join(
+            [parent] + [p for p in [env.get("PYTHONPATH")] if p])
+
+        start = time.perf_counter()
+        p = subprocess.Popen(command, env=env)
+
+        rss = None
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(p.pid, 0)
+            p.returncode = os.waitstatus_to_exitcode(status)
+            rss = peak_rss(usage)
+        else:
+            p.wait()
+
+        wall = time.perf_counter() - start
+
+        if p.returncode != 0:
+            raise Exception("benchmark {} failed with exit code {}".format(
+                name, p.returncode))
+
+        return wall, rss
+
+    def run_filegatherer(self, cx, scratch, args):
+        # the mods are created by the command for this scale first, unless
+        # the previous run already did
+        if scratch.created() != args:
+            scratch.empty()
+            self.run_command(cx, scratch, "filegatherer", args)
+            scratch.set_created(args)
+
+        root = os.path.join(scratch.instance(), "mods")
+
+        start = time.perf_counter()
+        fg = FileGatherer(root)
+        fg.ignore(SOURCE_IGNORE)
+        r = fg.get()
+        wall = time.perf_counter() - start
+
+        # the peak memory of this process is the peak of the whole bench, not
+        # of the benchmark, so it's not reported
+        return self.result(wall, len(r["files"]), r["total_size"], None)
+
+    def result(self, wall, files, size, rss):
+        return {
+            "wall": wall,
+            "files": files,
+            "bytes": size,
+            "files/s": files / max(wall, 1e-9),
+            "bytes/s": size / max(wall, 1e-9),
+            "peak_rss": rss}
+
+    def command_line(self, cx, scratch, args):
+        command = [sys.executable, "-m", __package__, "--log", "1"]
+        command += scratch.arguments()
+
+        for option, flag in FORWARDED_OPTIONS:
+            command += [flag, str(getattr(cx.options, option))]
+
+        if cx.options.use_async:
+            command.append("--async")
+
+        if cx.options.dry:
+            command.append("--dry")
+
+        return command + args
+
+    def report(self, results):
+        rows = []
+        for name, r in results.items():
+            rss = "?"
+            if r["peak_rss"] is not None:
+                rss = byte_size_string(r["peak_rss"])
+
+            rows.append((name, "{:.2f}s, {:.0f} files/s, {}/s, peak {}".format(
+                r["wall"], r["files/s"], byte_size_string(r["bytes/s"]), rss)))
+
+        info("\nresults:")
+        info(make_table(rows))
+
+    def save(self, cx, results):
+        doc = {
+            "scale": cx.options.scale,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "results": results}
+
+        info("saving results to {}", cx.options.save)
+        with open(cx.options.save, "w") as f:
+            json.dump(doc, f, indent=2)
+
+    def load_baseline(self, cx):
+        try:
+            with open(cx.options.baseline, "r") as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            error("can't read baseline {}: {}", cx.options.baseline, e)
+            return None
+
+        if baseline.get("scale") != cx.options.scale:
+            error("baseline {} is for scale '{}', not '{}'",
+                cx.options.baseline, baseline.get("scale"), cx.options.scale)
+            return None
+
+        return baseline
+
+    def compare(self, cx, baseline, results):
+        rows = compare(baseline, results, cx.options.threshold)
+
+        table = []
+        for name, before, after, ratio, verdict in rows:
+            table.append((name, "{:.2f}s -> {:.2f}s, x{:.2f}, {}".format(
+                before, after, ratio, verdict)))
+
+        info("\ncompared with {}:", cx.options.baseline)
+        info(make_table(table))
+
+        if any(r[4] == "slower" for r in rows):
+            return 1
+
+        return 0
@@ -0,0 +1,43 @@
+import os
+import hashlib
+from .payload import StreamedContent
+
+LINK_MODES = ["copy", "hardlink", "reflink", "symlink"]
+
+def content_hash(content):
+    if isinstance(content, StreamedContent):
+        content = content.description()
+
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+
+    return hashlib.sha1(content).hexdigest()
+
+
+class BlobStore:
+    def __init__(self, dir):
+        self.dir_ = dir
+
+        # hash of content -> path of the blob, per process
+        self.blobs_ = {}
+
+    def directory(self):
+        return self.dir_
+
+    def blob(self, ops, content):
+        # returns the path of the blob for the given content, writing it if
+        # this is the first time this process sees it
+        key = content_hash(content)
+        path = self.blobs_.get(key)
+
+        if path is None:
+            path = os.path.join(self.dir_, key)
+
+            # worker processes each have their own list of blobs, so the same
+            # blob can be written concurrently; it's written atomically so a
+            # link is never made to a partial file
+            ops.write_file_atomic(path, content)
+
+            self.blobs_[key] = path
+
+        return path
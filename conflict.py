@@ -1,4 +1,151 @@
-from .mod import Mod, File
+import os
+import json
+import time
+from .mod import Mod, File, create_mod
+from . import payload
+from .payload import Sampler
+from .log import *
+
+# numpy is optional and slow to import, it's set by the first ConflictPlan,
+# whose Sampler imports it, see payload.load_numpy()
+numpy = None
+
+TOPOLOGIES = ["chain", "star", "random"]
+
+# files are spread in directories of this many files
+FILES_PER_DIRECTORY = 1000
+
+ORACLE_FILENAME = "modutils-conflict-oracle.json"
+
+# number of winners written to the oracle at once
+ORACLE_CHUNK = 10000
+
+
+class ConflictPlan:
+    # file ids of each mod, in priority order: a file in a mod overwrites the
+    # same file in all the mods before it
+    #
+    # ids are integers, converted to paths by conflict_path(); with numpy, the
+    # ids of each mod are arrays and the winners are computed with vectorized
+    # assignments, lists and loops are used otherwise
+
+    def __init__(self, mods, files, overlap, topology, seed):
+        global numpy
+
+        sampler = Sampler(seed)
+        numpy = payload.numpy
+
+        self.names_ = ["mod-" + str(i + 1) for i in range(mods)]
+        self.files_ = files
+        self.ids_ = []
+
+        shared = int(files * overlap)
+
+        for i in range(mods):
+            self.ids_.append(
+                self.make_ids(sampler, i, shared, topology))
+
+    def make_ids(self, sampler, i, shared, topology):
+        # each mod has its own range of ids, but some of them are replaced by
+        # ids from another mod that comes before it
+        first = i * self.files_
+
+        if numpy is None:
+            ids = list(range(first, first + self.files_))
+        else:
+            ids = numpy.arange(first, first + self.files_)
+
+        if i == 0 or shared == 0:
+            return ids
+
+        if topology == "chain":
+            other = i - 1
+        elif topology == "star":
+            other = 0
+        else:
+            other = sampler.integer(i)
+
+        picked = sampler.choice(self.files_, shared)
+
+        if numpy is None:
+            for k in picked:
+                ids[k] = self.ids_[other][k]
+        else:
+            ids[picked] = self.ids_[other][picked]
+
+        return ids
+
+    def mod_count(self):
+        return len(self.names_)
+
+    def mod_name(self, i):
+        return self.names_[i]
+
+    def mod_ids(self, i):
+        return self.ids_[i]
+
+    def winners(self):
+        # index of the winning mod for each id, -1 for ids not in any mod
+        count = self.mod_count() * self.files_
+
+        if numpy is None:
+            w = [-1] * count
+            for i, ids in enumerate(self.ids_):
+                for id in ids:
+                    w[id] = i
+        else:
+            w = numpy.full(count, -1, dtype=numpy.int32)
+            for i, ids in enumerate(self.ids_):
+                w[ids] = i
+
+        return w
+
+    def conflicts(self):
+        # number of ids that are in more than one mod
+        if numpy is None:
+            counts = [0] * (self.mod_count() * self.files_)
+            for ids in self.ids_:
+                for id in ids:
+                    counts[id] += 1
+
+            return sum(1 for c in counts if c > 1)
+        else:
+            counts = numpy.bincount(numpy.concatenate(self.ids_))
+            return int((counts > 1).sum())
+
+
+def conflict_path(id):
+    return str(id // FILES_PER_DIRECTORY) + "/" + str(id) + ".txt"
+
+def conflict_files(name, ids):
+    # the content has the mod name so the winner can be checked
+    for id in ids:
+        path = conflict_path(int(id))
+        yield File(path, name + " " + path)
+
+def oracle_entries(winners):
+    # winners is an iterable of (path, mod name), yields them as json
+    for path, mod in winners:
+        yield json.dumps(path) + ": " + json.dumps(mod)
+
+def oracle_chunks(mods, entries):
+    # mods is the list of mod names in priority order, entries are the
+    # winners as json, see oracle_entries(); yields the json in pieces of
+    # ORACLE_CHUNK winners because it can be big
+    parts = ['{"mods": ', json.dumps(mods), ', "winners": {']
+    sep = ""
+
+    for e in entries:
+        parts.append(sep + e)
+        sep = ", "
+
+        if len(parts) >= ORACLE_CHUNK:
+            yield "".join(parts)
+            parts = []
+
+    parts.append("}}")
+    yield "".join(parts)
+
 
 class Conflict:
     def name(self):
@@ -7,12 +154,116 @@ class Conflict:
     def create_parser(self, sp):
         p = sp.add_parser(
             self.name(),
-            help="creates three mods with conflicting files",
-            description="creates three mods with conflicting files")
+            help="creates mods with conflicting files",
+            description="creates mods with conflicting files; without " +
+                        "--mods, creates three small mods with a fixed set " +
+                        "of conflicts; a json file mapping each path to " +
+                        "the mod that wins it is written in the instance " +
+                        "directory")
+
+        p.add_argument(
+            "--mods",
+            type=int,
+            default=None,
+            help="number of mods to create")
+
+        p.add_argument(
+            "--files",
+            type=int,
+            default=100,
+            help="number of files in each mod with --mods, defaults to 100")
+
+        p.add_argument(
+            "--overlap",
+            type=float,
+            default=0.5,
+            help="fraction of the files in a mod that are also in another " +
+                 "mod, defaults to 0.5")
+
+        p.add_argument(
+            "--topology",
+            type=str,
+            choices=TOPOLOGIES,
+            default="chain",
+            help="which mod the files of a mod overlap with: 'chain' for " +
+                 "the previous mod, 'star' for the first mod, 'random' for " +
+                 "any previous mod, defaults to 'chain'")
+
+        p.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="seed for picking overlapping files, defaults to 0")
 
         return p
 
     def run(self, cx):
+        if cx.options.mods is None:
+            return self.run_fixed(cx)
+
+        if not 0 <= cx.options.overlap <= 1:
+            error("--overlap must be between 0 and 1")
+            return 1
+
+        start = time.time()
+
+        plan = ConflictPlan(
+            cx.options.mods, cx.options.files, cx.options.overlap,
+            cx.options.topology, cx.options.seed)
+
+        winners = plan.winners()
+        conflicts = plan.conflicts()
+
+        info("planned {} mods, {} conflicting paths in {:.2f}s",
+            plan.mod_count(), conflicts, time.time() - start)
+
+        cx.clear_directory(cx.mods_directory())
+
+        items = []
+        for i in range(plan.mod_count()):
+            items.append((plan.mod_name(i), plan.mod_ids(i)))
+
+        # and a meta.ini per mod
+        cx.expect_files(sum(len(ids) for _, ids in items) + len(items))
+
+        cx.pool().map(self.create_mod, items)
+
+        names = [plan.mod_name(i) for i in range(plan.mod_count())]
+        self.write_oracle(cx, names, self.plan_entries(plan, winners))
+
+        return 0
+
+    def create_mod(self, cx, item):
+        name, ids = item
+
+        m = Mod(name)
+        m.add_source(conflict_files(name, ids))
+        m.create(cx)
+
+    def plan_entries(self, plan, winners):
+        # oracle entries for the ids that are in a mod, found without a python
+        # loop with numpy; paths and mod names don't need escaping, so they're
+        # formatted directly instead of with json.dumps()
+        names = [plan.mod_name(i) for i in range(plan.mod_count())]
+
+        if numpy is None:
+            for id in range(len(winners)):
+                w = winners[id]
+                if w >= 0:
+                    yield '"{}": "{}"'.format(conflict_path(id), names[w])
+
+            return
+
+        ids = numpy.flatnonzero(winners >= 0)
+
+        # converted to python ints one chunk at a time
+        for i in range(0, len(ids), ORACLE_CHUNK):
+            chunk = ids[i:i + ORACLE_CHUNK]
+
+            for id, w in zip(chunk.tolist(), winners[chunk].tolist()):
+                yield '"{}": "{}"'.format(conflict_path(id), names[w])
+
+    def run_fixed(self, cx):
         cx.clear_directory(cx.mods_directory())
 
         a = Mod("mod-1")
@@ -39,8 +290,29 @@ class Conflict:
         for i in range(15):
             b.add_file(File(str(i), str(i)))
 
-        a.create(cx)
-        b.create(cx)
-        c.create(cx)
+        mods = [a, b, c]
+        cx.pool().map(create_mod, mods)
+
+        # later mods win
+        winners = {}
+        for m in mods:
+            for name in m.file_names():
+                winners[name] = m.name()
+
+        names = [m.name() for m in mods]
+        self.write_oracle(
+            cx, names, oracle_entries(sorted(winners.items())))
 
         return 0
+
+    def write_oracle(self, cx, mods, entries):
+        # streamed to the file, and not counted in the stats like other
+        # bookkeeping files
+        path = os.path.join(cx.instance_directory(), ORACLE_FILENAME)
+        info("writing oracle to {}", path)
+
+        if os.path.exists(path):
+            cx.delete_file(path)
+
+        for chunk in oracle_chunks(mods, entries):
+            cx.append_file(path, chunk)
@@ -1,32 +1,222 @@
 import os
 import configparser
-from .operations import DryOperations, RealOperations
+from .operations import DryOperations, RealOperations, AsyncOperations
+from .blobs import BlobStore, content_hash
+from .manifest import Manifest, manifest_from_options, load_manifest
+from .progress import Progress
 from .log import *
 
+# asyncio, archivers, pool, profiling and planner are only imported by the
+# methods that need them: they're slow to import and most runs only use some
+# of them, or none for commands like dump
+
+class Stats:
+    def __init__(self):
+        self.files = 0
+        self.directories = 0
+        self.bytes = 0
+        self.unchanged = 0
+
+        # archives created, and entries in cleared directories, only counted
+        # by dry runs, see planner.py
+        self.archives = 0
+        self.cleared = 0
+
+    def add(self, other):
+        self.files += other.files
+        self.directories += other.directories
+        self.bytes += other.bytes
+        self.unchanged += other.unchanged
+        self.archives += other.archives
+        self.cleared += other.cleared
+
+    def empty(self):
+        return (
+            self.files == 0 and self.directories == 0 and self.bytes == 0 and
+            self.unchanged == 0 and self.archives == 0 and self.cleared == 0)
+
+
 class Context:
     SUPER_PATH = os.path.join("build", "modorganizer_super")
 
     class ValidationFailed(Exception):
         pass
 
-    def __init__(self, opts):
+    def __init__(self, opts, validate=True):
+        # without validate, the context doesn't use an instance: paths aren't
+        # checked and nothing is read from the instance, for commands that
+        # don't touch it, like bench
         self.ops_ = None
         self.options = opts
         self.mods_ = None
         self.dl_ = None
         self.overwrite_ = None
+        self.stats_ = Stats()
+        self.pool_ = None
+
+        # directories created during this run, File.create() asks for the
+        # parent directory of every file
+        self.dirs_ = set()
+
+        # directories created by the current job in a worker process, None
+        # in the main process; they're counted by the main process when the
+        # results are merged, because workers create the same parents
+        self.job_dirs_ = None
+
+        # directories being created by the async path and the event loop it
+        # runs on, see run_async()
+        self.pending_dirs_ = {}
+        self.loop_ = None
+
+        # content store for --link-mode, None when copying
+        self.blobs_ = None
 
-        self.validate()
+        # files generated by this run and, with --incremental, by the
+        # previous run
+        self.manifest_ = manifest_from_options(opts)
+        self.previous_ = None
+
+        # see archivers.py, set by archiver()
+        self.archiver_ = None
+
+        # progress line, see start_progress()
+        self.progress_ = None
+
+        if validate:
+            self.validate()
 
         if self.options.dry:
             info("this is a dry run")
             self.ops_ = DryOperations()
+        elif self.options.use_async:
+            self.ops_ = AsyncOperations(
+                self.options.trash == "wait", self.options.archive_jobs,
+                self.options.async_limit)
         else:
-            self.ops_ = RealOperations()
+            self.ops_ = RealOperations(
+                self.options.trash == "wait", self.options.archive_jobs)
+
+        # operation timings with --profile, see profiling.py
+        self.profile_ = None
+
+        if self.options.profile is not None:
+            from .profiling import Profile, ProfiledOperations
+
+            self.profile_ = Profile()
+            self.ops_ = ProfiledOperations(self.ops_, self.profile_)
+
+        if not validate:
+            return
 
         if not self.options.no_ini:
             self.read_ini()
 
+        if self.options.link_mode != "copy":
+            self.prepare_blobs()
+
+        if self.options.incremental:
+            self.load_previous_manifest()
+
+    def __getstate__(self):
+        # contexts are sent to worker processes, which don't need the pool
+        state = self.__dict__.copy()
+        state["pool_"] = None
+        state["pending_dirs_"] = {}
+        state["loop_"] = None
+        state["progress_"] = None
+        return state
+
+    def close(self):
+        self.stop_progress()
+
+        if self.pool_ is not None:
+            self.pool_.close()
+            self.pool_ = None
+
+        # hardlinks and reflinks don't need the blobs anymore
+        if self.blobs_ is not None and self.options.link_mode != "symlink":
+            log_op("clearing directory {}", self.blobs_.directory())
+            self.ops_.clear_directory(self.blobs_.directory())
+
+        if self.loop_ is not None:
+            self.loop_.close()
+            self.loop_ = None
+
+        self.ops_.close()
+
+    def pool(self):
+        if self.pool_ is None:
+            from .pool import Pool
+            self.pool_ = Pool(self)
+
+        return self.pool_
+
+    def stats(self):
+        return self.stats_
+
+    def start_progress(self):
+        # shows files/s, bytes/s and an eta on one line until close(), if
+        # stdout is a terminal; only used by the main process, whose stats
+        # include the results of worker processes as they come in
+        if not Progress.supported():
+            return
+
+        self.progress_ = Progress(self)
+        self.progress_.start()
+
+    def stop_progress(self):
+        if self.progress_ is not None:
+            self.progress_.stop()
+            self.progress_ = None
+
+    def expect_files(self, count):
+        # called by commands that know how many files they'll write, for the
+        # eta of the progress line
+        if self.progress_ is not None:
+            self.progress_.expect(count)
+
+    def reset_job(self):
+        self.stats_ = Stats()
+        self.manifest_.take_files()
+        self.job_dirs_ = []
+
+        if self.profile_ is not None:
+            self.profile_.take()
+
+    def job_results(self):
+        profile = None
+        if self.profile_ is not None:
+            profile = self.profile_.take()
+
+        dirs = self.job_dirs_
+        self.job_dirs_ = []
+
+        return (self.stats_, self.manifest_.take_files(), profile, dirs)
+
+    def merge_job_results(self, r):
+        stats, files, profile, dirs = r
+        self.stats_.add(stats)
+        self.manifest_.merge_files(files)
+
+        for d in dirs:
+            if d not in self.dirs_:
+                self.dirs_.add(d)
+                self.stats_.directories += 1
+
+        if profile is not None:
+            self.profile_.merge(profile)
+
+    def write_profile(self):
+        # called once the context is closed, so closing is included
+        if self.profile_ is None:
+            return
+
+        info("\noperations:")
+        info(self.profile_.table())
+
+        info("writing profile to {}", self.options.profile)
+        self.profile_.write(self.options.profile, self.options)
+
     def validate(self):
         self.validate_base()
         self.validate_instance()
@@ -38,8 +228,8 @@ class Context:
         path = os.path.join(dir, file)
 
         if not os.path.exists(path):
-            print("bad base directory '{}', {} not found"
-                .format(dir, file))
+            error("bad base directory '{}', {} not found",
+                dir, file)
 
             raise Context.ValidationFailed()
 
@@ -49,8 +239,8 @@ class Context:
         file = os.path.basename(path)
 
         if not os.path.exists(path):
-            print("bad instance directory '{}', {} not found"
-                .format(dir, file))
+            error("bad instance directory '{}', {} not found",
+                dir, file)
 
             raise Context.ValidationFailed()
 
@@ -63,22 +253,44 @@ class Context:
                 path = os.path.join(dir, f)
 
                 if not os.path.exists(path):
-                    print("bad destination directory '{}', {}/ not found"
-                        .format(dir, f))
+                    error("bad destination directory '{}', {}/ not found",
+                        dir, f)
 
                     raise Context.ValidationFailed()
 
             super = self.super_directory()
 
             if not os.path.exists(super):
-                print("bad destination directory '{}', {} not found"
-                    .format(dir, Context.SUPER_PATH))
+                error("bad destination directory '{}', {} not found",
+                    dir, Context.SUPER_PATH)
 
                 raise Context.ValidationFailed()
         except Context.ValidationFailed:
-            print("note that the destination directory defaults to $pwd")
+            error("note that the destination directory defaults to $pwd")
             raise
 
+    def archiver(self):
+        # the archiver is only looked for the first time an archive is
+        # created, so commands that don't create any work without 7z; raises
+        # ValidationFailed if it's not available
+        if self.archiver_ is not None:
+            return self.archiver_
+
+        from .archivers import make_archiver
+
+        archiver = make_archiver(self.options.archiver)
+
+        if archiver is None:
+            error("7z not found, install it or use --archiver python")
+            raise Context.ValidationFailed()
+
+        log_op("using the {} archiver", archiver.name())
+
+        self.archiver_ = archiver
+        self.ops_.set_archiver(archiver)
+
+        return archiver
+
     def res_file(self, file):
         dir = os.path.dirname(__file__)
         return os.path.join(dir, "res", file)
@@ -107,12 +319,95 @@ class Context:
         else:
             return None
 
+    def prepare_blobs(self):
+        # blobs are per command so that linked files created by a previous
+        # run of a different command don't break
+        dir = os.path.join(self.blobs_directory(), self.options.command)
+        self.ops_.create_directory(dir)
+
+        # symlinks kept by an incremental run still point to the blobs of the
+        # previous run; blobs are named after their content, so the ones that
+        # are written again are the same
+        if self.options.incremental and self.options.link_mode == "symlink":
+            log_op("keeping blobs in {} for incremental run", dir)
+        else:
+            log_op("clearing directory {}", dir)
+            self.ops_.clear_directory(dir)
+
+        self.blobs_ = BlobStore(dir)
+
+    def load_previous_manifest(self):
+        self.previous_ = load_manifest(self.manifest_path())
+
+        if self.previous_ is None:
+            info("no manifest from a previous run, generating everything")
+            return
+
+        # files would have to be replaced by links or the other way around
+        link_mode = self.previous_.argument("link_mode")
+        if link_mode != self.options.link_mode:
+            info("link mode changed from {}, generating everything", link_mode)
+            self.previous_ = None
+
+    def up_to_date(self):
+        # whether this is the same command with the same arguments as the
+        # previous run, in which case there's nothing to do
+        if self.previous_ is None:
+            return False
+
+        return self.previous_.same_run(self.manifest_)
+
+    def finish(self):
+        # called once the command has run successfully; only commands that
+        # cleared a directory generate files and have a manifest, and it's
+        # only kept for --incremental, the next run that isn't incremental
+        # deletes it
+        if len(self.manifest_.roots()) == 0 or not self.options.incremental:
+            return
+
+        if self.previous_ is not None:
+            self.delete_stale_files()
+
+        path = self.manifest_path()
+        log_op("writing manifest {}", path)
+        self.ops_.write_file(path, self.manifest_.to_json())
+
+    def delete_stale_files(self):
+        # files from the previous run that weren't generated again
+        dirs = set()
+
+        for path in self.previous_.files():
+            if path in self.manifest_.files():
+                continue
+
+            if not self.manifest_.owns(path):
+                continue
+
+            if os.path.exists(path):
+                self.delete_file(path)
+
+            dirs.add(os.path.dirname(path))
+
+        # deepest first so parents can become empty
+        for dir in sorted(dirs, key=len, reverse=True):
+            while self.manifest_.owns(dir):
+                if not self.ops_.remove_empty_directory(dir):
+                    break
+
+                dir = os.path.dirname(dir)
+
+    def manifest_path(self):
+        return os.path.join(self.instance_directory(), Manifest.FILENAME)
+
     def settings_ini(self):
         return os.path.join(self.instance_directory(), "ModOrganizer.ini")
 
     def instance_directory(self):
         return os.path.join(self.options.base_dir, self.options.instance)
 
+    def blobs_directory(self):
+        return os.path.join(self.instance_directory(), "modutils-blobs")
+
     def mods_directory(self):
         if self.mods_ is not None:
             return self.mods_
@@ -139,24 +434,271 @@ class Context:
 
     def clear_directory(self, path):
         path = os.path.normpath(path)
+
+        if len(self.manifest_.roots()) == 0:
+            # a manifest is only written once the command has finished, so an
+            # interrupted run is never mistaken for a complete one
+            if os.path.exists(self.manifest_path()):
+                self.delete_file(self.manifest_path())
+
+        self.manifest_.add_root(path)
+
+        if self.previous_ is not None and path in self.previous_.roots():
+            log_op("keeping directory {} for incremental run", path)
+            return
+
         log_op("clearing directory {}", path)
         self.ops_.clear_directory(path)
 
+        if self.options.dry:
+            from .planner import count_entries
+            self.stats_.cleared += count_entries(path)
+        self.dirs_.clear()
+
     def create_directory(self, path):
-        path = os.path.normpath(path)
-        log_op("creating directory {}", path)
-        self.ops_.create_directory(path)
+        if not self.add_directory(path):
+            return
+
+        self.ops_.create_directory(os.path.normpath(path))
+
+    def add_directory(self, path):
+        # returns False if the directory was already created
+        if path in self.dirs_:
+            return False
+
+        self.dirs_.add(path)
+
+        if logging_ops():
+            log_op("creating directory {}", os.path.normpath(path))
+
+        if self.job_dirs_ is None:
+            self.stats_.directories += 1
+        else:
+            self.job_dirs_.append(path)
+
+        return True
 
     def write_file(self, path, content):
         path = os.path.normpath(path)
-        log_op("writing to {}", path)
-        self.ops_.write_file(path, content)
+
+        if not self.needs_write(path, content):
+            return
+
+        if self.blobs_ is None:
+            log_op("writing to {}", path)
+            self.ops_.write_file(path, content)
+        else:
+            source = self.blobs_.blob(self.ops_, content)
+            log_op("linking {} to {}", path, source)
+            self.ops_.link_file(source, path, self.options.link_mode)
+
+        self.stats_.files += 1
+        self.stats_.bytes += len(content)
+
+    def write_files(self, files):
+        # files is an iterable of (path, content), parent directories are
+        # created as needed; only one line is logged for the whole batch
+        if self.options.use_async:
+            self.run_async(self.write_files_async(files))
+            return
+
+        batch, size = self.prepare_batch(files)
+
+        if len(batch) == 0:
+            return
+
+        if self.blobs_ is None:
+            log_op("writing {} files, {}", len(batch), byte_size_string(size))
+            self.ops_.write_files(batch)
+        else:
+            self.link_batch(batch, size)
+
+        self.stats_.files += len(batch)
+        self.stats_.bytes += size
+
+    def write_archives(self, items):
+        # items is an iterable of (path, path in archive, content): each file
+        # is an archive with one file in it, created concurrently and
+        # streamed to disk, see RealOperations.write_archives()
+        if self.options.use_async:
+            self.run_async(self.write_archives_async(items))
+            return
+
+        from .archivers import ArchiveContent
+
+        archiver = self.archiver()
+
+        files = []
+        for path, archived, content in items:
+            files.append((path, ArchiveContent(archiver, archived, content)))
+
+        batch, size = self.prepare_batch(files)
+
+        if len(batch) == 0:
+            return
+
+        if self.blobs_ is None:
+            log_op("writing {} archives, {} at a time",
+                len(batch), self.options.archive_jobs)
+            self.ops_.write_archives(batch)
+        else:
+            self.link_batch(batch, size)
+
+        self.stats_.files += len(batch)
+        self.stats_.bytes += size
+        self.stats_.archives += len(batch)
+
+    def prepare_batch(self, files, dirs=None):
+        # normalizes paths, creates directories and drops unchanged files;
+        # returns the files to write and their total size; if dirs is a set,
+        # directories are added to it instead of being created
+        batch = []
+        size = 0
+
+        for path, content in files:
+            path = os.path.normpath(path)
+
+            if not self.needs_write(path, content):
+                continue
+
+            if dirs is None:
+                self.create_directory(os.path.dirname(path))
+            else:
+                dirs.add(os.path.dirname(path))
+
+            batch.append((path, content))
+            size += len(content)
+
+        return batch, size
+
+    def link_batch(self, batch, size):
+        links = []
+        for path, content in batch:
+            links.append((self.blobs_.blob(self.ops_, content), path))
+
+        log_op("linking {} files, {}", len(batch), byte_size_string(size))
+        self.ops_.link_files(links, self.options.link_mode)
+
+    def run_async(self, coro):
+        # runs a coroutine that uses the async methods below; they work with
+        # any operations, but only AsyncOperations overlaps them; only used
+        # with --async, on one event loop for the whole command, created on
+        # demand and closed by close()
+        import asyncio
+
+        if self.loop_ is None:
+            self.loop_ = asyncio.new_event_loop()
+
+        try:
+            return self.loop_.run_until_complete(coro)
+        except BaseException:
+            # the other coroutines of a gather() that failed are still
+            # pending, like when the archiver isn't available
+            tasks = asyncio.all_tasks(self.loop_)
+            for t in tasks:
+                t.cancel()
+
+            self.loop_.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+            raise
+        finally:
+            self.pending_dirs_ = {}
+
+    async def create_directory_async(self, path):
+        import asyncio
+
+        if not self.add_directory(path):
+            # may still be in the works in another coroutine
+            f = self.pending_dirs_.get(path)
+            if f is not None:
+                await f
+
+            return
+
+        f = asyncio.ensure_future(
+            self.ops_.create_directory_async(os.path.normpath(path)))
+
+        self.pending_dirs_[path] = f
+        await f
+
+    async def write_files_async(self, files):
+        batch, size = await self.prepare_batch_async(files)
+
+        if len(batch) == 0:
+            return
+
+        if self.blobs_ is None:
+            log_op("writing {} files, {}", len(batch), byte_size_string(size))
+            await self.ops_.write_files_async(batch)
+        else:
+            self.link_batch(batch, size)
+
+        self.stats_.files += len(batch)
+        self.stats_.bytes += size
+
+    async def write_archives_async(self, items):
+        from .archivers import ArchiveContent
+
+        archiver = self.archiver()
+
+        files = []
+        for path, archived, content in items:
+            files.append((path, ArchiveContent(archiver, archived, content)))
+
+        batch, size = await self.prepare_batch_async(files)
+
+        if len(batch) == 0:
+            return
+
+        if self.blobs_ is None:
+            log_op("writing {} archives", len(batch))
+            await self.ops_.write_archives_async(batch)
+        else:
+            self.link_batch(batch, size)
+
+        self.stats_.files += len(batch)
+        self.stats_.bytes += size
+        self.stats_.archives += len(batch)
+
+    async def prepare_batch_async(self, files):
+        import asyncio
+
+        dirs = set()
+        batch, size = self.prepare_batch(files, dirs)
+
+        await asyncio.gather(*(self.create_directory_async(d) for d in dirs))
+
+        return batch, size
+
+    def needs_write(self, path, content):
+        # with --incremental, adds the file to the manifest if it's in a
+        # cleared directory and returns False if the previous run generated
+        # the same file; files are not hashed or kept in memory otherwise
+        if not self.options.incremental or not self.manifest_.owns(path):
+            return True
+
+        size = len(content)
+        hash = content_hash(content)
+        self.manifest_.add(path, size, hash)
+
+        if self.previous_ is not None:
+            if self.previous_.get(path) == [size, hash]:
+                self.stats_.unchanged += 1
+                return False
+
+        return True
 
     def temp_file(self):
         file = self.ops_.temp_file()
         log_op("generating temp file '{}'", file)
         return file
 
+    def append_file(self, path, content):
+        # not recorded in the manifest or the stats, used for bookkeeping
+        # files like journals
+        log_op("appending to {}", path)
+        self.ops_.append_file(os.path.normpath(path), content)
+
     def delete_file(self, path):
         log_op("deleting {}", path)
         self.ops_.delete_file(path)
@@ -165,10 +707,14 @@ class Context:
         input = os.path.normpath(input)
         output = os.path.normpath(output)
         log_op("archiving {} into {}, exclude={}", input, output, exclude)
+        self.archiver()
         self.ops_.archive(input, output, exclude)
+        self.stats_.archives += 1
 
     def archive_string(self, path, content):
         log_op("archiving data into archive, archived filename is {}", path)
+        self.archiver()
+        self.stats_.archives += 1
         return self.ops_.archive_string(path, content)
 
     def archive_files(self, files, out, cwd=None):
@@ -176,6 +722,7 @@ class Context:
             cwd = os.getcwd()
 
         log_op("archiving {} files into {} with cwd {}", len(files), out, cwd)
+        self.archiver()
 
         content = ""
         for f in files:
@@ -185,8 +732,47 @@ class Context:
 
         self.write_file(listfile, content)
         self.ops_.archive_files(listfile, out, cwd)
+        self.stats_.archives += 1
         self.delete_file(listfile)
 
+    def plan(self):
+        # checked against the first cleared directory, which is where most
+        # of the files go, or the destination; None if the command doesn't
+        # generate anything, like dump or vfs
+        from .planner import Plan
+
+        roots = self.manifest_.roots()
+
+        if len(roots) == 0:
+            if self.stats_.empty():
+                return None
+
+            return Plan(self.stats_, self.options.destination)
+
+        return Plan(self.stats_, roots[0])
+
+    def log_summary(self):
+        if self.options.dry:
+            # the calibration is the only thing a dry run writes
+            from .planner import Throughput
+
+            plan = self.plan()
+            if plan is not None:
+                plan.log(Throughput.measure(plan.path()))
+
+            return
+
+        if self.stats_.files == 0 and self.stats_.unchanged == 0:
+            return
+
+        info("wrote {} files in {} directories, {}",
+            self.stats_.files, self.stats_.directories,
+            byte_size_string(self.stats_.bytes))
+
+        if self.stats_.unchanged > 0:
+            info("{} files were unchanged since the last run",
+                self.stats_.unchanged)
+
     def dump(self):
         info("options:")
         info(make_table(vars(self.options).items()))
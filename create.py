@@ -1,8 +1,12 @@
 import random
-from .mod import Mod, File, Download
+from .mod import Mod, File, Download, create_downloads
+from .payload import add_size_arguments, make_sizes, sized_content
 
 DEFAULT_EXTENSION = "7z"
 
+# number of files of each type in a mod created with --huge
+HUGE_COUNT = 100000
+
 class CreateMods:
     def name(self):
         return "mods"
@@ -29,6 +33,13 @@ class CreateMods:
             action="store_true",
             help="creates mods with lots of files")
 
+        p.add_argument(
+            "--compact",
+            action="store_true",
+            help="keeps the files of a mod in a compact table instead of " +
+                 "one object per file; with --huge, the files are " +
+                 "generated up front instead of while they're written")
+
         p.add_argument(
             "count",
             type=int,
@@ -40,85 +51,106 @@ class CreateMods:
             default=5,
             help="number of files to create per mod")
 
+        add_size_arguments(p, "the .txt and .ini files")
+
         return p
 
     def run(self, cx):
         cx.clear_directory(cx.mods_directory())
+        cx.expect_files(cx.options.count * self.files_per_mod(cx))
+        cx.pool().map(self.create_mod, range(cx.options.count))
 
-        for i in range(cx.options.count):
-            name = "mod-" + str(i + 1)
-            m = Mod(name)
+        return 0
 
-            if cx.options.huge:
-                self.create_huge(cx, m)
-            else:
-                for i in range(cx.options.files):
-                    self.add_text_file(cx, m, str(i + 1), ".txt")
-                    self.add_text_file(cx, m, str(i + 1), ".ini")
+    def files_per_mod(self, cx):
+        # including meta.ini
+        copies = 2 if cx.options.duplicate_hidden else 1
 
-                if cx.options.esm:
-                    m.add_file(File(name + ".esm", ""))
+        if cx.options.huge:
+            # txt and ini, images and esps
+            return HUGE_COUNT * 2 * copies + HUGE_COUNT * 2 + 1
 
-            m.create(cx)
+        esm = 1 if cx.options.esm else 0
+        return cx.options.files * 2 * copies + esm + 1
 
-        return 0
+    def create_mod(self, cx, i):
+        name = "mod-" + str(i + 1)
+        m = Mod(name, cx.options.compact)
+        sizes = make_sizes(cx.options, i)
+
+        if cx.options.huge:
+            self.create_huge(cx, m, sizes)
+        else:
+            for i in range(cx.options.files):
+                self.add_text_file(cx, m, str(i + 1), ".txt", sizes)
+                self.add_text_file(cx, m, str(i + 1), ".ini", sizes)
+
+            if cx.options.esm:
+                m.add_file(File(name + ".esm", ""))
 
-    def create_huge(self, cx, m):
-        count = 100000
+        m.create(cx)
+
+    def create_huge(self, cx, m, sizes):
+        if cx.options.compact:
+            m.add_files(self.huge_files(cx, m, sizes))
+        else:
+            # files are generated lazily while the mod is being created,
+            # nothing is kept in memory
+            m.add_source(self.huge_files(cx, m, sizes))
+
+    def huge_files(self, cx, m, sizes):
+        count = HUGE_COUNT
         txt_count = count
         ini_count = count
         image_count = count
         esp_count = count
 
-        print("txt")
-        dir = ""
-        for i in range(txt_count):
-            if (i % 50) == 0:
-                dir = "txt_" + str(i)
+        for i, dir in self.huge_names(txt_count, "txt_"):
+            name = dir + "/" + str(i + 1)
+            yield from self.text_files(cx, m, name, ".txt", sizes)
 
-            self.add_text_file(cx, m, dir + "/" + str(i + 1), ".txt")
+        for i, dir in self.huge_names(ini_count, "ini_"):
+            name = dir + "/" + str(i + 1)
+            yield from self.text_files(cx, m, name, ".ini", sizes)
 
-        print("ini")
-        dir = ""
-        for i in range(ini_count):
-            if (i % 50) == 0:
-                dir = "ini_" + str(i)
-
-            self.add_text_file(cx, m, dir + "/" + str(i + 1), ".ini")
-
-        print("images")
         image = ""
         with open(cx.res_file("image.png"), "rb") as f:
             image = f.read()
 
-        dir = ""
-        for i in range(image_count):
-            if (i % 50) == 0:
-                dir = "image_" + str(i)
-
-            m.add_file(File(dir + "/" + str(i + 1) + ".png", image))
+        for i, dir in self.huge_names(image_count, "image_"):
+            yield File(dir + "/" + str(i + 1) + ".png", image)
 
-        print("esp")
         esp = ""
         with open(cx.res_file("dummy.esp"), "rb") as f:
             esp = f.read()
 
+        for i, dir in self.huge_names(esp_count, "esp_"):
+            yield File(dir + "/" + str(i + 1) + ".esp", esp)
+
+    def huge_names(self, count, prefix):
+        # yields (index, dir) pairs, with a new directory every 50 files
         dir = ""
-        for i in range(esp_count):
+        for i in range(count):
             if (i % 50) == 0:
-                dir = "esp_" + str(i)
+                dir = prefix + str(i)
 
-            m.add_file(File(dir + "/" + str(i + 1) + ".esp", esp))
+            yield i, dir
 
+    def add_text_file(self, cx, m, name, ext, sizes):
+        m.add_files(self.text_files(cx, m, name, ext, sizes))
 
-    def add_text_file(self, cx, m, name, ext):
+    def text_files(self, cx, m, name, ext, sizes):
         filename = name + ext
-        content = m.name() + " " + filename
 
-        m.add_file(File(filename, content))
+        if sizes is None:
+            content = m.name() + " " + filename
+        else:
+            content = sized_content(cx.options, sizes)
+
+        yield File(filename, content)
 
         if cx.options.duplicate_hidden:
-            m.add_file(File(filename + ".mohidden", content))
+            yield File(filename + ".mohidden", content)
 
 
 class CreateDownloads:
@@ -148,6 +180,8 @@ class CreateDownloads:
             help="specifies extension (defaults to " +
                  "'" + DEFAULT_EXTENSION + "')")
 
+        add_size_arguments(p, "the file in each archive")
+
         p.add_argument(
             "count",
             type=int,
@@ -158,12 +192,27 @@ class CreateDownloads:
     def run(self, cx):
         cx.clear_directory(cx.downloads_directory())
 
+        per_download = 1 if cx.options.no_meta else 2
+        cx.expect_files(cx.options.count * per_download)
+
+        sizes = make_sizes(cx.options, 0)
+
+        dls = []
         for i in range(cx.options.count):
             name = "mod " + str(i + 1)
-            d = self.create_download(cx, name)
-            d.create(cx)
+            dls.append(self.create_download(cx, name, sizes))
+
+        # one list of downloads per worker process, each of which runs up to
+        # --archive-jobs archivers at the same time
+        jobs = max(1, cx.pool().jobs())
+        per_job = (len(dls) + jobs - 1) // jobs
+        chunks = [dls[i:i + per_job] for i in range(0, len(dls), per_job)]
+
+        cx.pool().map(create_downloads, chunks)
 
-    def create_download(self, cx, name):
+        return 0
+
+    def create_download(self, cx, name, sizes):
         nexus_id = None
         file_id = None
         version = self.generate_version()
@@ -174,7 +223,11 @@ class CreateDownloads:
             nexus_id = self.generate_nexus_id()
             file_id = self.generate_file_id()
 
-        return Download(name, nexus_id, file_id, version, ext, meta)
+        content = ""
+        if sizes is not None:
+            content = sized_content(cx.options, sizes)
+
+        return Download(name, nexus_id, file_id, version, ext, meta, content)
 
     def generate_nexus_id(self):
         return random.randint(1000, 10000)
@@ -204,9 +257,21 @@ class Overwrite:
             help="creates files in the overwrite directory",
             description="creates files in the overwrite directory")
 
+        add_size_arguments(p, "the files")
+
         return p
 
     def run(self, cx):
         cx.clear_directory(cx.overwrite_directory())
-        File("a.txt", "a").create(cx, cx.overwrite_directory())
-        File("b.txt", "b").create(cx, cx.overwrite_directory())
+
+        sizes = make_sizes(cx.options, 0)
+        a, b = "a", "b"
+
+        if sizes is not None:
+            a = sized_content(cx.options, sizes)
+            b = sized_content(cx.options, sizes)
+
+        File("a.txt", a).create(cx, cx.overwrite_directory())
+        File("b.txt", b).create(cx, cx.overwrite_directory())
+
+        return 0
@@ -1,9 +1,23 @@
 import os
 import re
+import concurrent.futures
 from ctypes import *
-from pathlib import Path
 from .log import *
 
+# names of files and directories not included in the source archive
+SOURCE_IGNORE = [
+    r"\..+",     # dot files
+    r".*\.log",  # logs
+    r".*\.tlog", # logs
+    r".*\.dll",  # dll
+    r".*\.exe",  # exe
+    r".*\.lib",  # lib
+    r".*\.obj",  # obj
+    r".*\.ts",   # ts
+    r".*\.aps",  # aps
+    r"vsbuild"   # vsbuild
+]
+
 # returns the requested version information from the given file
 #
 # `language` should be an 8-character string combining both the language and
@@ -87,60 +101,78 @@ def get_version_from_rc(rc):
     return None
 
 
-def byte_size_string(num, suffix='B'):
-    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
-        if abs(num) < 1024.0:
-            return "%3.1f%s%s" % (num, unit, suffix)
-        num /= 1024.0
-    return "%.1f%s%s" % (num, 'Yi', suffix)
-
-
 class FileGatherer:
-    def __init__(self, root):
+    # lists the files under root with their size, skipping files and
+    # directories whose name matches one of the ignore patterns; top-level
+    # directories are walked in parallel threads
+
+    def __init__(self, root, threads=None):
+        # threads defaults to what ThreadPoolExecutor picks
         self.root_ = root
-        self.ignore_ = []
-        self.files_ = []
-        self.total_ = 0
+        self.threads_ = threads
+        self.ignore_ = None
 
     def ignore(self, list):
-        self.ignore_ = [re.compile(s) for s in list]
+        # all the patterns in one regex, each still only has to match the
+        # start of a name
+        self.ignore_ = re.compile("|".join("(?:" + s + ")" for s in list))
 
     def get(self):
-        self.files_ = []
-        self.total_ = 0
-
-        self.add_dir(self.root_)
+        # paths of files are relative to the root, with native separators, in
+        # the same order as a recursive walk of the root
+        parts = []
+
+        with concurrent.futures.ThreadPoolExecutor(self.threads_) as ex:
+            for e in self.entries(self.root_):
+                if e.is_dir():
+                    parts.append(ex.submit(self.walk, e))
+                else:
+                    parts.append([(e.name, e.stat().st_size)])
+
+            files = []
+            for p in parts:
+                if isinstance(p, list):
+                    files += p
+                else:
+                    files += p.result()
+
+        total = sum(size for path, size in files)
+
+        return {"total_size": total, "files": files}
+
+    def walk(self, top):
+        # files under the given top-level directory entry, depth-first in
+        # directory order with a stack of iterators instead of recursion;
+        # the relative path is built along the way and the size comes from
+        # the entry, which doesn't need another stat() on windows
+        files = []
+        stack = [(self.entries(top.path), top.name)]
 
-        return {"total_size": self.total_, "files": self.files_}
+        while len(stack) > 0:
+            it, rel = stack[-1]
+            e = next(it, None)
 
-    def add_dir(self, dir):
-        for entry in Path(dir).iterdir():
-            if self.is_ignored(entry):
+            if e is None:
+                stack.pop()
                 continue
 
-            if entry.is_dir():
-                self.add_dir(entry)
-            else:
-                size = entry.stat().st_size
-                path = str(entry)
+            name = rel + os.sep + e.name
 
-                if not path.startswith(self.root_):
-                    print("path doesn't start with root dir '{}'?", this.root_)
-                    raise Exception()
+            if e.is_dir():
+                stack.append((self.entries(e.path), name))
+            else:
+                files.append((name, e.stat().st_size))
 
-                path = path[len(self.root_):]
-                while path[0] == '/' or path[0] == '\\':
-                    path = path[1:]
+        return files
 
-                self.files_.append((path, size))
-                self.total_ += size
+    def entries(self, path):
+        # iterator over the entries of a directory that aren't ignored; the
+        # directory is read at once so it isn't kept open during the walk
+        with os.scandir(path) as it:
+            return iter([e for e in it if not self.is_ignored(e.name)])
 
-    def is_ignored(self, f):
-        for e in self.ignore_:
-            if e.match(f.name):
-                return True
-
-        return False
+    def is_ignored(self, name):
+        return self.ignore_ is not None and self.ignore_.match(name) is not None
 
 class DevBuild:
     def name(self):
@@ -240,21 +272,8 @@ class DevBuild:
         root_dir = cx.super_directory()
         destination = cx.options.destination
 
-        ignore = [
-            r"\..+",     # dot files
-            r".*\.log",  # logs
-            r".*\.tlog", # logs
-            r".*\.dll",  # dll
-            r".*\.exe",  # exe
-            r".*\.lib",  # lib
-            r".*\.obj",  # obj
-            r".*\.ts",   # ts
-            r".*\.aps",  # aps
-            r"vsbuild"   # vsbuild
-        ]
-
         fg = FileGatherer(root_dir)
-        fg.ignore(ignore)
+        fg.ignore(SOURCE_IGNORE)
         r = fg.get()
 
         # should be below 20MB
@@ -273,17 +292,17 @@ class DevBuild:
         if r["total_size"] <= max:
             return
 
-        print("total size of source files would be {}, expected something "
-              "below {}, something might be wrong".format(
-                    byte_size_string(r["total_size"]),
-                    byte_size_string(max)))
+        warn("total size of source files would be {}, expected something "
+             "below {}, something might be wrong",
+                byte_size_string(r["total_size"]),
+                byte_size_string(max))
 
         if cx.options.force:
-            print("but --force is specified, ignoring")
+            warn("but --force is specified, ignoring")
             return True
 
-        print("use --force to ignore")
-        print("dumping top 10 largest files:")
+        warn("use --force to ignore")
+        warn("dumping top 10 largest files:")
 
         list = sorted(r["files"], key=lambda f: f[1], reverse=True)
 
@@ -291,7 +310,7 @@ class DevBuild:
             if i >= 10:
                 break
 
-            print(list[i][0] + " " + byte_size_string(list[i][1]))
+            warn("{} {}", list[i][0], byte_size_string(list[i][1]))
 
         return False
 
@@ -342,7 +361,7 @@ class DevBuild:
 
         v = None
         try:
-            v = get_version_string(ec, "FileVersion")
+            v = get_version_string(exe, "FileVersion")
             if v == "" or v is None:
                 warn("failed to get FileVersion from '{}'", exe)
                 v = None
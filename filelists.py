@@ -0,0 +1,199 @@
+import os
+import json
+from .mod import Mod, File
+from .tree import letters
+from .log import *
+
+JOURNAL_FILENAME = "modutils-filelists-journal.txt"
+
+
+def make_dir_name(dir, depth):
+    # same as the old script up to 26 directories, then "ba", "bb", etc.
+    return letters(dir) * (depth + 1)
+
+def make_file_name(mod_name, dir, file):
+    return mod_name + "." + dir.replace("/", ".") + "." + str(file + 1) + ".txt"
+
+def filelist_directories(mod_name, top, dir_count, max_depth):
+    # yields the path of every directory under the given top-level directory,
+    # same tree as the old create-filelists.py script: each directory has
+    # dir_count children down to max_depth, and every directory that has
+    # children also has an extra one named after the mod and its own path
+    if max_depth <= 0:
+        return
+
+    stack = [(make_dir_name(top, 0), 0)]
+
+    while len(stack) > 0:
+        path, depth = stack.pop()
+        yield path
+
+        if depth + 1 >= max_depth:
+            continue
+
+        if dir_count > 0:
+            yield path + "/" + mod_name + "." + path.replace("/", ".")
+
+        for dir in reversed(range(dir_count)):
+            stack.append((path + "/" + make_dir_name(dir, depth + 1), depth + 1))
+
+def filelist_files(mod_name, top, dir_count, file_count, max_depth):
+    for dir in filelist_directories(mod_name, top, dir_count, max_depth):
+        for file in range(file_count):
+            name = make_file_name(mod_name, dir, file)
+            yield File(dir + "/" + name, name)
+
+
+class Journal:
+    # progress of a run: the first line has the arguments, then one line per
+    # top-level directory of a mod that was completely written; workers
+    # append to it as they go, so an interrupted run can skip what's done
+
+    def __init__(self, path, args):
+        self.path_ = path
+        self.header_ = json.dumps(args, sort_keys=True) + "\n"
+
+    def path(self):
+        return self.path_
+
+    def load(self):
+        # returns the set of (mod name, top) that are done, or None if the
+        # journal doesn't exist or was written with different arguments
+        try:
+            with open(self.path_, "r") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return None
+
+        if len(lines) == 0 or lines[0] != self.header_:
+            return None
+
+        done = set()
+        for line in lines[1:]:
+            # a line without a newline was interrupted while written
+            if not line.endswith("\n"):
+                continue
+
+            parts = line.split()
+            if len(parts) == 2:
+                done.add((parts[0], int(parts[1])))
+
+        return done
+
+    def start(self, cx):
+        if os.path.exists(self.path_):
+            cx.delete_file(self.path_)
+
+        cx.append_file(self.path_, self.header_)
+
+    def add(self, cx, mod_name, top):
+        cx.append_file(self.path_, mod_name + " " + str(top) + "\n")
+
+    def finish(self, cx):
+        if os.path.exists(self.path_):
+            cx.delete_file(self.path_)
+
+
+class FileLists:
+    def name(self):
+        return "filelists"
+
+    def create_parser(self, sp):
+        p = sp.add_parser(
+            self.name(),
+            help="creates mods with deep trees of uniquely named files",
+            description="creates mods where every directory has --dirs " +
+                        "subdirectories down to --depth levels and --files " +
+                        "files named after the mod and directory; progress " +
+                        "is journaled in the instance directory so an " +
+                        "interrupted run can be continued with --resume")
+
+        p.add_argument(
+            "--mods",
+            type=int,
+            default=10,
+            help="number of mods to create, defaults to 10")
+
+        p.add_argument(
+            "--dirs",
+            type=int,
+            default=5,
+            help="number of subdirectories in each directory, defaults to 5")
+
+        p.add_argument(
+            "--files",
+            type=int,
+            default=5,
+            help="number of files in each directory, defaults to 5")
+
+        p.add_argument(
+            "--depth",
+            type=int,
+            default=5,
+            help="depth of the tree, defaults to 5")
+
+        p.add_argument(
+            "--resume",
+            action="store_true",
+            help="continues an interrupted run with the same arguments " +
+                 "instead of starting over")
+
+        return p
+
+    def run(self, cx):
+        journal = self.journal(cx)
+        done = None
+
+        if cx.options.resume:
+            done = journal.load()
+
+            if done is None:
+                info("nothing to resume, starting over")
+
+        if done is None:
+            done = set()
+            cx.clear_directory(cx.mods_directory())
+            journal.start(cx)
+        else:
+            info("resuming, {} of {} directories already done",
+                len(done), cx.options.mods * cx.options.dirs)
+
+        items = []
+        for i in range(cx.options.mods):
+            name = "mod-" + str(i + 1)
+            tops = [t for t in range(cx.options.dirs) if (name, t) not in done]
+
+            if len(tops) > 0:
+                items.append((name, tops))
+
+        # one job per mod
+        cx.pool().map(self.create_mod, items)
+
+        journal.finish(cx)
+
+        return 0
+
+    def journal(self, cx):
+        path = os.path.join(cx.instance_directory(), JOURNAL_FILENAME)
+
+        return Journal(path, {
+            "mods": cx.options.mods,
+            "dirs": cx.options.dirs,
+            "files": cx.options.files,
+            "depth": cx.options.depth})
+
+    def create_mod(self, cx, item):
+        name, tops = item
+        journal = self.journal(cx)
+
+        # each top-level directory is journaled once all of its files are
+        # written, a directory that was interrupted is written again; the
+        # meta.ini of the mod is written with the first one
+        for top in tops:
+            m = Mod(name, meta=(top == 0))
+            m.add_source(filelist_files(
+                name, top, cx.options.dirs, cx.options.files,
+                cx.options.depth))
+
+            m.create(cx)
+            journal.add(cx, name, top)
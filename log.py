@@ -1,5 +1,20 @@
+import os
+import sys
+import atexit
+import threading
 from enum import Flag, auto
 
+# buffered lines are written by the output thread at least this often, in
+# seconds, or as soon as this many are waiting
+FLUSH_INTERVAL = 0.1
+FLUSH_LINES = 1000
+
+# the output and its thread are internal, modules use the functions
+__all__ = [
+    "LogLevels", "set_log_level", "add_log_level", "logging_ops",
+    "flush_log", "set_status", "info", "warn", "error", "log_op",
+    "make_table", "byte_size_string"]
+
 class LogLevels(Flag):
     NONE = 0
     ERROR = auto()
@@ -10,29 +25,142 @@ class LogLevels(Flag):
 
 log_level = LogLevels.INFO | LogLevels.WARN | LogLevels.ERROR
 
+# one bool per level, updated with log_level; checking a flag is slow enough
+# to show up when log_op() is called for every file
+_error = True
+_warn = True
+_info = True
+_ops = False
+
+
+class Output:
+    # log lines are queued and written to stdout in batches by a background
+    # thread, so logging doesn't wait on the terminal; a status line, like the
+    # progress, stays below the log lines on terminals
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # also called in forked processes, where the thread doesn't exist and
+        # the locks may have been held by another thread of the parent
+        self.lock_ = threading.Lock()
+        self.io_lock_ = threading.Lock()
+        self.wake_ = threading.Event()
+        self.thread_ = None
+        self.lines_ = []
+        self.status_ = None
+        self.shown_ = None
+
+    def write(self, line):
+        with self.lock_:
+            self.lines_.append(line)
+            count = len(self.lines_)
+            self.start()
+
+        if count >= FLUSH_LINES:
+            self.wake_.set()
+
+    def set_status(self, s):
+        # None removes it
+        with self.lock_:
+            self.status_ = s
+            self.start()
+
+    def start(self):
+        # called with the lock held
+        if self.thread_ is None:
+            self.thread_ = threading.Thread(target=self.run, daemon=True)
+            self.thread_.start()
+
+    def run(self):
+        while True:
+            self.wake_.wait(FLUSH_INTERVAL)
+            self.wake_.clear()
+            self.flush()
+
+    def flush(self):
+        with self.io_lock_:
+            with self.lock_:
+                lines = self.lines_
+                status = self.status_
+                self.lines_ = []
+
+            if len(lines) == 0 and status == self.shown_:
+                return
+
+            s = ""
+            if self.shown_ is not None:
+                # erases the status line
+                s += "\r\x1b[K"
+
+            if len(lines) > 0:
+                s += "\n".join(lines) + "\n"
+
+            if status is not None:
+                s += status
+
+            self.shown_ = status
+
+            sys.stdout.write(s)
+            sys.stdout.flush()
+
+
+output = Output()
+
+# lines are written before forking so they're not lost or written twice, and
+# the child starts with its own thread; there is no fork on windows
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(before=output.flush, after_in_child=output.reset)
+atexit.register(output.flush)
+
+
 def set_log_level(lv):
     global log_level
     log_level = lv
+    update_levels()
 
 def add_log_level(lv):
     global log_level
     log_level |= lv
+    update_levels()
+
+def update_levels():
+    global _error, _warn, _info, _ops
+    _error = bool(log_level & LogLevels.ERROR)
+    _warn = bool(log_level & LogLevels.WARN)
+    _info = bool(log_level & LogLevels.INFO)
+    _ops = bool(log_level & LogLevels.OPERATIONS)
+
+def logging_ops():
+    # for callers that would compute arguments of log_op() for nothing
+    return _ops
+
+def flush_log():
+    output.flush()
+
+def set_status(s):
+    output.set_status(s)
 
 def info(s, *args):
-    if log_level & LogLevels.INFO:
-        print(s.format(*args))
+    # messages are only formatted if their level is enabled
+    if _info:
+        output.write(s.format(*args))
 
 def warn(s, *args):
-    if log_level & LogLevels.WARN:
-        print(s.format(*args))
+    if _warn:
+        output.write(s.format(*args))
 
 def error(s, *args):
-    if log_level & LogLevels.ERROR:
-        print(s.format(*args))
+    # errors are written right away, they often come right before an
+    # exception or an exit
+    if _error:
+        output.write(s.format(*args))
+        output.flush()
 
 def log_op(s, *args, **kwargs):
-    if log_level & LogLevels.OPERATIONS:
-        print(s.format(*args))
+    if _ops:
+        output.write(s.format(*args))
 
 def make_table(rows):
     longest = 0
@@ -48,3 +176,10 @@ def make_table(rows):
         s += (" . " + f).format(k, str(v))
 
     return s
+
+def byte_size_string(num, suffix='B'):
+    for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
+        if abs(num) < 1024.0:
+            return "%3.1f%s%s" % (num, unit, suffix)
+        num /= 1024.0
+    return "%.1f%s%s" % (num, 'Yi', suffix)
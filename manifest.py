@@ -0,0 +1,109 @@
+import os
+import json
+import hashlib
+
+# options that don't change what is generated, ignored when comparing the
+# arguments of two runs
+IGNORED_OPTIONS = [
+    "dry", "log", "jobs", "trash", "archive_jobs", "use_async", "async_limit",
+    "incremental", "plan", "profile", "cprofile"]
+
+# options that are paths to input files, like a scenario; the content of the
+# file is part of the arguments, so editing it is a different run
+INPUT_OPTIONS = ["file"]
+
+def manifest_from_options(opts):
+    args = {}
+    for k, v in vars(opts).items():
+        if k not in IGNORED_OPTIONS:
+            args[k] = v
+
+        if k in INPUT_OPTIONS and v is not None:
+            args[k + "_hash"] = file_hash(v)
+
+    return Manifest(opts.command, args)
+
+def file_hash(path):
+    # None if the file can't be read, the command reports the error
+    try:
+        with open(path, "rb") as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def load_manifest(path):
+    # returns None if there's no manifest or it can't be read
+    try:
+        with open(path, "r") as f:
+            j = json.load(f)
+
+        m = Manifest(j["command"], j["arguments"])
+        m.roots_ = j["roots"]
+        m.files_ = j["files"]
+
+        return m
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+class Manifest:
+    FILENAME = "modutils-manifest.json"
+
+    def __init__(self, command=None, arguments=None):
+        self.command_ = command
+        self.arguments_ = arguments or {}
+
+        # directories that were cleared by the command, everything in there
+        # belongs to the manifest
+        self.roots_ = []
+
+        # path -> [size, hash]
+        self.files_ = {}
+
+    def to_json(self):
+        return json.dumps({
+            "command": self.command_,
+            "arguments": self.arguments_,
+            "roots": self.roots_,
+            "files": self.files_})
+
+    def same_run(self, other):
+        return (
+            self.command_ == other.command_ and
+            self.arguments_ == other.arguments_)
+
+    def argument(self, name):
+        return self.arguments_.get(name)
+
+    def roots(self):
+        return self.roots_
+
+    def add_root(self, path):
+        if path not in self.roots_:
+            self.roots_.append(path)
+
+    def owns(self, path):
+        for r in self.roots_:
+            if path.startswith(r + os.sep):
+                return True
+
+        return False
+
+    def files(self):
+        return self.files_
+
+    def get(self, path):
+        return self.files_.get(path)
+
+    def add(self, path, size, hash):
+        self.files_[path] = [size, hash]
+
+    def take_files(self):
+        # used by worker processes, which send back the files created by each
+        # job
+        files = self.files_
+        self.files_ = {}
+        return files
+
+    def merge_files(self, files):
+        self.files_.update(files)
@@ -1,5 +1,24 @@
 import os
 import itertools
+import array
+from .payload import SizedContent
+
+# number of files given to Context.write_files() at once when creating a mod,
+# files from lazy sources are only generated one batch at a time
+BATCH_SIZE = 1000
+
+# number of batches being written while the next one is generated, only
+# overlaps with --async
+BATCHES_IN_FLIGHT = 2
+
+# contents at least this long are deduplicated, shorter ones are cheaper to
+# store again than to look up
+MIN_SHARED_CONTENT = 64
+
+# kinds of content stored in a FileTable
+CONTENT_BYTES = 0
+CONTENT_TEXT = 1
+CONTENT_SIZED = 2
 
 MOD_META_CONTENT = """[General]
 modid=0
@@ -60,13 +79,143 @@ class File:
         cx.write_file(path, self.content_)
 
 
+class FileTable:
+    # compact replacement for a list of File objects: names are split in an
+    # interned directory and a file name packed in a single buffer, and
+    # contents are stored in a pool, shared when they're large enough
+    #
+    # it only supports the parts of the list interface used by Mod
+
+    def __init__(self):
+        # interned directories, the index is the directory id
+        self.dirs_ = []
+        self.dir_ids_ = {}
+
+        # per file: directory id, end offset of the name in names_ and content
+        # id
+        self.file_dirs_ = array.array("I")
+        self.name_ends_ = array.array("Q")
+        self.file_contents_ = array.array("I")
+        self.names_ = bytearray()
+
+        # content pool: end offset in contents_ and kind of content, per
+        # content id; sized contents are stored as "strategy:size"
+        self.content_ends_ = array.array("Q")
+        self.content_kinds_ = bytearray()
+        self.contents_ = bytearray()
+        self.shared_ = {}
+
+    def __len__(self):
+        return len(self.file_dirs_)
+
+    def __iter__(self):
+        # File objects are created on the fly
+        for i in range(len(self)):
+            yield File(self.name(i), self.content(i))
+
+    def append(self, f):
+        self.add(f.name(), f.content())
+
+    def add(self, name, content):
+        dir, _, filename = name.rpartition("/")
+
+        self.file_dirs_.append(self.dir_id(dir))
+        self.names_ += filename.encode("utf-8")
+        self.name_ends_.append(len(self.names_))
+        self.file_contents_.append(self.content_id(content))
+
+    def name(self, i):
+        begin = self.name_ends_[i - 1] if i > 0 else 0
+        end = self.name_ends_[i]
+        filename = self.names_[begin:end].decode("utf-8")
+
+        dir = self.dirs_[self.file_dirs_[i]]
+        if dir == "":
+            return filename
+
+        return dir + "/" + filename
+
+    def content(self, i):
+        id = self.file_contents_[i]
+
+        begin = self.content_ends_[id - 1] if id > 0 else 0
+        end = self.content_ends_[id]
+        content = bytes(self.contents_[begin:end])
+        kind = self.content_kinds_[id]
+
+        if kind == CONTENT_TEXT:
+            return content.decode("utf-8")
+        elif kind == CONTENT_SIZED:
+            strategy, size = content.decode("utf-8").split(":")
+            return SizedContent(int(size), strategy)
+
+        return content
+
+    def dir_id(self, dir):
+        id = self.dir_ids_.get(dir)
+
+        if id is None:
+            id = len(self.dirs_)
+            self.dirs_.append(dir)
+            self.dir_ids_[dir] = id
+
+        return id
+
+    def content_id(self, content):
+        shared = (len(content) >= MIN_SHARED_CONTENT)
+
+        if shared:
+            id = self.shared_.get(content)
+            if id is not None:
+                return id
+
+        id = len(self.content_ends_)
+
+        if isinstance(content, SizedContent):
+            s = content.strategy() + ":" + str(content.size())
+            self.contents_ += s.encode("utf-8")
+            self.content_kinds_.append(CONTENT_SIZED)
+        elif isinstance(content, str):
+            self.contents_ += content.encode("utf-8")
+            self.content_kinds_.append(CONTENT_TEXT)
+        else:
+            self.contents_ += content
+            self.content_kinds_.append(CONTENT_BYTES)
+
+        self.content_ends_.append(len(self.contents_))
+
+        if shared:
+            self.shared_[content] = id
+
+        return id
+
+
+def make_file(f):
+    # files can be given as plain strings, in which case the name is also used
+    # as the content
+    if isinstance(f, str):
+        return File(f, f)
+    else:
+        return f
+
+
 class Mod:
-    def __init__(self, name):
+    def __init__(self, name, compact=False, meta=True):
+        # meta is False for parts of a mod created separately, the meta.ini
+        # is only written with one of them
         self.name_ = name
-        self.files_ = []
         self.internal_files_ = []
+        self.sources_ = []
+
+        # a FileTable uses much less memory than a list of File objects when
+        # there are lots of files
+        if compact:
+            self.files_ = FileTable()
+        else:
+            self.files_ = []
 
-        self.add_internal_file(File("meta.ini", MOD_META_CONTENT))
+        if meta:
+            self.add_internal_file(File("meta.ini", MOD_META_CONTENT))
 
     def name(self):
         return self.name_
@@ -76,31 +225,86 @@ class Mod:
 
     def add_files(self, files):
         for f in files:
-            if isinstance(f, str):
-                self.add_file(File(f, f))
-            else:
-                self.add_file(f)
+            self.add_file(make_file(f))
+
+    def file_names(self):
+        # names of the files given to add_file() or add_files(), sources are
+        # not included
+        return [f.name() for f in self.files_]
+
+    def add_source(self, source):
+        # a source is any iterable of File objects or strings, like for
+        # add_files(), but it is only consumed when the mod is created; this
+        # allows generators to stream files to disk as they're produced
+        # instead of keeping all of them in memory
+        #
+        # note that generators can only be consumed once
+        self.sources_.append(source)
 
     def add_internal_file(self, f):
         self.internal_files_.append(f)
 
     def create(self, cx):
         path = os.path.join(cx.mods_directory(), self.name_)
-        self.create_files(cx, path)
+
+        if cx.options.use_async:
+            cx.run_async(self.create_files_async(cx, path))
+        else:
+            self.create_files(cx, path)
+
+    def files(self):
+        yield from itertools.chain(self.internal_files_, self.files_)
+
+        for s in self.sources_:
+            for f in s:
+                yield make_file(f)
 
     def create_files(self, cx, dir):
-        for f in itertools.chain(self.internal_files_, self.files_):
-            f.create(cx, dir)
+        batch = []
+
+        for f in self.files():
+            batch.append((os.path.join(dir, f.name()), f.content()))
+
+            if len(batch) >= BATCH_SIZE:
+                cx.write_files(batch)
+                batch = []
+
+        cx.write_files(batch)
+
+    async def create_files_async(self, cx, dir):
+        # the next batch is generated while the previous ones are written;
+        # asyncio is only imported with --async, it's slow to import
+        import asyncio
+
+        batch = []
+        pending = []
+
+        for f in self.files():
+            batch.append((os.path.join(dir, f.name()), f.content()))
+
+            if len(batch) >= BATCH_SIZE:
+                pending.append(asyncio.ensure_future(cx.write_files_async(batch)))
+                batch = []
+
+                if len(pending) > BATCHES_IN_FLIGHT:
+                    await pending.pop(0)
+
+                # lets the batches start
+                await asyncio.sleep(0)
+
+        pending.append(asyncio.ensure_future(cx.write_files_async(batch)))
+        await asyncio.gather(*pending)
 
 
 class Download:
-    def __init__(self, name, nexus_id, file_id, version, ext, meta):
+    def __init__(self, name, nexus_id, file_id, version, ext, meta, content=""):
         self.name_ = name
         self.nexus_id_ = nexus_id
         self.file_id_ = file_id
         self.version_ = version
         self.ext_ = ext
         self.meta_ = meta
+        self.content_ = content
         self.filename_ = self.make_filename()
 
     def make_filename(self):
@@ -114,16 +318,20 @@ class Download:
         return s + "." + self.ext_
 
     def create(self, cx):
-        dl = os.path.join(cx.downloads_directory(), self.filename_)
-        meta = os.path.join(cx.downloads_directory(), self.filename_ + ".meta")
+        create_downloads(cx, [self])
 
-        cx.write_file(dl, self.make_archive(cx))
+    def path(self, cx):
+        return os.path.join(cx.downloads_directory(), self.filename_)
 
-        if self.meta_:
-            cx.write_file(meta, self.meta_content())
+    def archive_path(self):
+        # path of the only file in the archive
+        return "data/textures/" + self.name_ + ".dds"
 
-    def make_archive(self, cx):
-        return cx.archive_string("data/textures/" + self.name_ + ".dds", "")
+    def content(self):
+        return self.content_
+
+    def meta(self):
+        return self.meta_
 
     def meta_content(self):
         if self.nexus_id_ is None:
@@ -144,3 +352,42 @@ class Download:
             mod_name=self.name_,
             version=self.version_,
             newest_version=self.version_)
+
+
+# used with Pool.map(), which calls f(cx, item)
+
+def create_mod(cx, m):
+    m.create(cx)
+
+def download_files(cx, dls):
+    # returns the archives and .meta files of the given downloads
+    archives = []
+    metas = []
+
+    for d in dls:
+        path = d.path(cx)
+        archives.append((path, d.archive_path(), d.content()))
+
+        if d.meta():
+            metas.append((path + ".meta", d.meta_content()))
+
+    return archives, metas
+
+def create_downloads(cx, dls):
+    # archives are created concurrently and streamed to disk
+    if cx.options.use_async:
+        cx.run_async(create_downloads_async(cx, dls))
+        return
+
+    archives, metas = download_files(cx, dls)
+    cx.write_archives(archives)
+    cx.write_files(metas)
+
+async def create_downloads_async(cx, dls):
+    # the .meta files are written while the archives are created
+    import asyncio
+
+    archives, metas = download_files(cx, dls)
+
+    await asyncio.gather(
+        cx.write_archives_async(archives), cx.write_files_async(metas))
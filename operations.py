@@ -4,9 +4,59 @@ import abc
 import time
 import shutil
 import tempfile
+import locale
+import errno
+import sys
+import threading
+from .payload import StreamedContent
 from .log import *
 
-SEVENZ = r"C:\Program Files\7-Zip\7z.exe"
+# concurrent.futures and asyncio are slow to import, they're imported by the
+# methods that create threads or use the event loop
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+
+# maximum number of directory handles kept open by RealOperations
+MAX_DIR_FDS = 256
+
+# number of threads used by RealOperations.write_files() and the maximum
+# number of files from the same directory written by one thread at a time
+WRITE_THREADS = 8
+WRITE_CHUNK = 64
+
+# linux ioctl that makes a copy-on-write clone of a file
+FICLONE = 0x40049409
+
+# cleared directories have their contents moved into this directory, next to
+# them, and deleted in the background by this many threads
+TRASH_DIR = ".modutils-trash"
+TRASH_THREADS = 4
+
+# windows can briefly deny access to files that were just renamed or deleted,
+# or that are opened by something else, like an antivirus; these operations
+# are retried this many times, waiting a bit longer each time
+RETRY_COUNT = 10
+RETRY_DELAY = 0.05
+
+# used to delete what's left in the trash once modutils has exited
+DETACHED_DELETE = (
+    "import shutil, sys\n"
+    "for p in sys.argv[1:]:\n"
+    "    shutil.rmtree(p, ignore_errors=True)\n")
+
+def retry_on_access_denied(f, *args):
+    for i in range(RETRY_COUNT):
+        try:
+            return f(*args)
+        except PermissionError:
+            if i + 1 == RETRY_COUNT:
+                raise
+
+            time.sleep(RETRY_DELAY * (i + 1))
 
 class OperationsImpl(metaclass=abc.ABCMeta):
     @abc.abstractmethod
@@ -21,46 +71,88 @@ class OperationsImpl(metaclass=abc.ABCMeta):
     def write_file(self, path, content):
         pass
 
+    def write_files(self, files):
+        # files is a list of (path, content); parent directories must already
+        # exist
+        for path, content in files:
+            self.write_file(path, content)
+
+    @abc.abstractmethod
+    def write_file_atomic(self, path, content):
+        pass
+
+    @abc.abstractmethod
+    def append_file(self, path, content):
+        # content is a small string appended in one write, so concurrent
+        # appends from multiple processes don't interleave
+        pass
+
+    @abc.abstractmethod
+    def link_file(self, source, path, mode):
+        pass
+
+    def link_files(self, links, mode):
+        # links is a list of (source, path), see blobs.LINK_MODES for modes
+        for source, path in links:
+            self.link_file(source, path, mode)
+
     @abc.abstractmethod
     def delete_file(self, path):
         pass
 
+    @abc.abstractmethod
+    def remove_empty_directory(self, path):
+        # returns False if the directory wasn't empty
+        pass
+
     @abc.abstractmethod
     def temp_file(self):
         pass
 
-    def archive(self, input, output, exclude=[]):
-        if os.path.exists(output):
-            raise Exception("file {} already exists".format(output))
+    def close(self):
+        pass
 
-        args = [SEVENZ, "a", output, "-r", "-mx=5", input]
-        for e in exclude:
-            args.append("-xr!" + e)
+    def set_archiver(self, archiver):
+        # called by Context before the first archive operation, see
+        # archivers.py
+        pass
 
-        self.run_process(args, None)
+    @abc.abstractmethod
+    def archive(self, input, output, exclude=[]):
+        pass
 
+    @abc.abstractmethod
     def archive_string(self, path, content):
-        # filename doesn't matter because the archive is dumped in stdout, but
-        # the extension dictates the compression type
-        return self.popen([SEVENZ, "a", "d.zip", "-si" + path, "-so"], content)
+        pass
 
-    def archive_files(self, listfile, output, cwd):
-        if os.path.exists(output):
-            raise Exception("file {} already exists".format(output))
+    def write_archives(self, files):
+        # files is a list of (path, ArchiveContent), see write_files()
+        self.write_files(files)
 
-        self.run_process([SEVENZ, "a", output, "@" + listfile], cwd)
+    # used by the async path of Context, see AsyncOperations; these run the
+    # blocking operations by default
 
-    @abc.abstractmethod
-    def run_process(self, input, output, cwd):
-        pass
+    async def create_directory_async(self, path):
+        self.create_directory(path)
+
+    async def write_files_async(self, files):
+        self.write_files(files)
+
+    async def write_archives_async(self, files):
+        self.write_archives(files)
 
     @abc.abstractmethod
-    def popen(self, args):
+    def archive_files(self, listfile, output, cwd):
         pass
 
 
 class DryOperations(OperationsImpl):
     def clear_directory(self, path):
+        # directories that would have been created earlier in the run don't
+        # exist, like the blobs directory
+        if not os.path.isdir(path):
+            return
+
         for f in os.listdir(path):
             fp = os.path.join(path, f)
 
@@ -75,39 +167,320 @@ class DryOperations(OperationsImpl):
     def write_file(self, path, content):
         pass
 
+    def write_files(self, files):
+        dirs = {}
+        for path, content in files:
+            dir = os.path.dirname(path)
+            count, size = dirs.get(dir, (0, 0))
+            dirs[dir] = (count + 1, size + len(content))
+
+        for dir in sorted(dirs):
+            count, size = dirs[dir]
+            log_op("  . {} files, {} in {}", count, byte_size_string(size), dir)
+
+    def write_file_atomic(self, path, content):
+        pass
+
+    def append_file(self, path, content):
+        pass
+
+    def link_file(self, source, path, mode):
+        pass
+
+    def link_files(self, links, mode):
+        dirs = {}
+        for source, path in links:
+            dir = os.path.dirname(path)
+            dirs[dir] = dirs.get(dir, 0) + 1
+
+        for dir in sorted(dirs):
+            log_op("  . {} {}s in {}", dirs[dir], mode, dir)
+
     def delete_file(self, path):
         pass
 
+    def remove_empty_directory(self, path):
+        return False
+
     def temp_file(self):
         return "tempfile"
 
-    def run_process(self, args, cwd):
-        if cwd is None:
-            log_op("would run: \"{}\"", " ".join(args))
-        else:
-            log_op("would run: \"{}\" with cwd={}", " ".join(args), cwd)
+    def archive(self, input, output, exclude=[]):
+        log_op("  . would archive {} into {}", input, output)
 
-    def popen(self, args, send):
-        log_op("would run: \"{}\"", " ".join(args))
+    def archive_string(self, path, content):
         return ""
 
+    def archive_files(self, listfile, output, cwd):
+        log_op("  . would archive files from {} into {}", listfile, output)
+
 
 class RealOperations(OperationsImpl):
+    def __init__(self, wait_for_trash=True, archive_jobs=1):
+        # open handles of directories that were written to, files are opened
+        # relative to them instead of resolving the full path every time;
+        # this is not supported on Windows
+        self.use_dir_fd_ = (os.open in os.supports_dir_fd)
+        self.dir_fds_ = {}
+
+        # used by write_files(), created on demand
+        self.writers_ = None
+
+        # deletes the contents of cleared directories in the background, see
+        # clear_directory()
+        self.trash_ = None
+        self.trash_dirs_ = set()
+        self.trash_paths_ = set()
+        self.wait_for_trash_ = wait_for_trash
+        self.stop_trash_ = threading.Event()
+
+        # link modes that failed and fell back to copying, only warned once
+        self.failed_links_ = set()
+
+        # see archivers.py, set by set_archiver(); write_archives() runs up
+        # to archive_jobs archivers at the same time, in threads created on
+        # demand
+        self.archiver_ = None
+        self.archive_jobs_ = archive_jobs
+        self.archive_threads_ = None
+
+        # text content is encoded the same way open() would
+        self.encoding_ = locale.getpreferredencoding(False)
+
+    def __getstate__(self):
+        # handles and threads can't be shared with worker processes
+        state = self.__dict__.copy()
+        state["dir_fds_"] = {}
+        state["writers_"] = None
+        state["archive_threads_"] = None
+        state["trash_"] = None
+        state["trash_dirs_"] = set()
+        state["trash_paths_"] = set()
+        state["stop_trash_"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.stop_trash_ = threading.Event()
+
+    def close(self):
+        if self.writers_ is not None:
+            self.writers_.shutdown()
+            self.writers_ = None
+
+        if self.archive_threads_ is not None:
+            self.archive_threads_.shutdown()
+            self.archive_threads_ = None
+
+        self.close_dir_fds()
+        self.close_trash()
+
+    def close_trash(self):
+        if self.trash_ is not None:
+            if not self.wait_for_trash_:
+                # threads are interrupted and whatever is left is deleted by
+                # a separate process that outlives this one
+                self.stop_trash_.set()
+                self.trash_.shutdown(cancel_futures=True)
+                self.trash_ = None
+                self.detach_trash()
+                return
+
+            info("waiting for cleared files to be deleted")
+            self.trash_.shutdown()
+            self.trash_ = None
+
+        # the unique directories and the trash directories should be empty by
+        # now, they're also created when there was nothing to delete
+        for p in sorted(self.trash_paths_, key=len, reverse=True):
+            self.remove_empty_directory(p)
+
+        for d in self.trash_dirs_:
+            self.remove_empty_directory(d)
+
+        self.trash_paths_ = set()
+        self.trash_dirs_ = set()
+
+    def detach_trash(self):
+        dirs = [d for d in self.trash_dirs_ if os.path.exists(d)]
+        if len(dirs) == 0:
+            return
+
+        info("cleared files will be deleted in the background")
+
+        kwargs = {}
+        if os.name == "nt":
+            kwargs["creationflags"] = (
+                subprocess.DETACHED_PROCESS |
+                subprocess.CREATE_NEW_PROCESS_GROUP)
+        else:
+            kwargs["start_new_session"] = True
+
+        subprocess.Popen(
+            [sys.executable, "-c", DETACHED_DELETE] + dirs,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            **kwargs)
+
     def clear_directory(self, path):
-        for f in os.listdir(path):
-            fp = os.path.join(path, f)
+        # handles could point to directories that are about to be deleted
+        self.close_dir_fds()
 
-            if os.path.isfile(fp):
-                os.unlink(fp)
-            else:
-                shutil.rmtree(fp)
+        # everything in the directory is moved to a trash directory on the same
+        # filesystem, which is nearly instant, and deleted in the background
+        trash = os.path.join(os.path.dirname(path), TRASH_DIR)
+        os.makedirs(trash, exist_ok=True)
 
-        time.sleep(0.3)
+        # leftovers from previous runs are deleted along with this one
+        for f in os.listdir(trash):
+            self.delete_in_background(os.path.join(trash, f))
+
+        self.trash_dirs_.add(trash)
+
+        unique = str(os.getpid()) + "-" + str(time.time_ns())
+        dest = os.path.join(trash, unique)
+        os.mkdir(dest)
+        self.trash_paths_.add(dest)
+
+        for f in os.listdir(path):
+            src = os.path.join(path, f)
+
+            try:
+                retry_on_access_denied(os.rename, src, os.path.join(dest, f))
+            except OSError as e:
+                # the trash is on a different filesystem, can happen with
+                # junctions or mount points
+                if e.errno != errno.EXDEV:
+                    raise
+
+                self.delete_tree(src)
+                continue
+
+            self.delete_in_background(os.path.join(dest, f))
+
+    def delete_in_background(self, path):
+        if path in self.trash_paths_:
+            return
+
+        self.trash_paths_.add(path)
+
+        if self.trash_ is None:
+            import concurrent.futures
+            self.trash_ = concurrent.futures.ThreadPoolExecutor(
+                max_workers=TRASH_THREADS)
+
+        self.trash_.submit(self.delete_tree_task, path)
+
+    def delete_tree_task(self, path):
+        try:
+            self.delete_tree(path)
+        except OSError as e:
+            warn("failed to delete {}: {}", path, e)
+
+    def delete_tree(self, path):
+        # iterative so it can be interrupted when closing, files that are
+        # already gone are ignored since leftovers can be deleted by more
+        # than one process
+        if not os.path.isdir(path) or os.path.islink(path):
+            self.unlink_if_exists(path)
+            return
+
+        stack = [path]
+        dirs = []
+
+        while len(stack) > 0:
+            if self.stop_trash_.is_set():
+                return
+
+            dir = stack.pop()
+            dirs.append(dir)
+
+            try:
+                with os.scandir(dir) as it:
+                    for e in it:
+                        if e.is_dir(follow_symlinks=False):
+                            stack.append(e.path)
+                        else:
+                            self.unlink_if_exists(e.path)
+            except FileNotFoundError:
+                pass
+
+        for dir in reversed(dirs):
+            try:
+                os.rmdir(dir)
+            except FileNotFoundError:
+                pass
+
+    def unlink_if_exists(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
 
     def create_directory(self, path):
-        os.makedirs(path, exist_ok=True)
+        retry_on_access_denied(os.makedirs, path, 0o777, True)
 
     def write_file(self, path, content):
+        if self.use_dir_fd_:
+            dir, name = os.path.split(path)
+            self.write_file_at(self.dir_fd(dir), name, content)
+        else:
+            self.write_file_path(path, content)
+
+    def write_files(self, files):
+        # files are grouped by directory and each thread writes a chunk of
+        # files from the same directory, so a directory handle is opened once
+        # per chunk instead of once per file
+        chunks = self.write_chunks(files)
+
+        if len(chunks) == 1:
+            self.write_chunk(chunks[0])
+        else:
+            # list() waits for completion and raises any exception
+            list(self.writers().map(self.write_chunk, chunks))
+
+    def write_chunks(self, files):
+        # returns a list of (dir, [(name, content)]), at most WRITE_CHUNK files
+        # each
+        dirs = {}
+        for path, content in files:
+            dir, name = os.path.split(path)
+            dirs.setdefault(dir, []).append((name, content))
+
+        chunks = []
+        for dir in sorted(dirs):
+            names = dirs[dir]
+            for i in range(0, len(names), WRITE_CHUNK):
+                chunks.append((dir, names[i:i + WRITE_CHUNK]))
+
+        return chunks
+
+    def write_chunk(self, chunk):
+        dir, files = chunk
+
+        if not self.use_dir_fd_:
+            for name, content in files:
+                self.write_file_path(os.path.join(dir, name), content)
+
+            return
+
+        # the handle cache isn't thread-safe, use a separate handle
+        fd = os.open(dir, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+
+        try:
+            for name, content in files:
+                self.write_file_at(fd, name, content)
+        finally:
+            os.close(fd)
+
+    def write_file_path(self, path, content):
+        if isinstance(content, StreamedContent):
+            with open(path, "wb") as f:
+                content.write_to(f.fileno())
+
+            return
+
         mode = "w"
         if isinstance(content, bytes):
             mode += "b"
@@ -115,23 +488,257 @@ class RealOperations(OperationsImpl):
         with open(path, mode) as f:
             f.write(content)
 
+    def write_file_at(self, dir_fd, name, content):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC
+        fd = os.open(name, flags, 0o666, dir_fd=dir_fd)
+
+        try:
+            if isinstance(content, StreamedContent):
+                content.write_to(fd)
+                return
+
+            if isinstance(content, str):
+                content = content.encode(self.encoding_)
+
+            view = memoryview(content)
+            while len(view) > 0:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+    def write_file_atomic(self, path, content):
+        temp = path + "." + str(os.getpid()) + ".tmp"
+        self.write_file_path(temp, content)
+        os.replace(temp, path)
+
+    def append_file(self, path, content):
+        # opened in append mode, the buffer is flushed in one write on close
+        with open(path, "a") as f:
+            f.write(content)
+
+    def link_files(self, links, mode):
+        chunks = []
+        for i in range(0, len(links), WRITE_CHUNK):
+            chunks.append((mode, links[i:i + WRITE_CHUNK]))
+
+        if len(chunks) == 1:
+            self.link_chunk(chunks[0])
+        else:
+            list(self.writers().map(self.link_chunk, chunks))
+
+    def link_chunk(self, chunk):
+        mode, links = chunk
+
+        for source, path in links:
+            self.link_file(source, path, mode)
+
+    def link_file(self, source, path, mode):
+        try:
+            self.link_file_impl(source, path, mode)
+        except FileExistsError:
+            os.remove(path)
+            self.link_file_impl(source, path, mode)
+
+    def link_file_impl(self, source, path, mode):
+        if mode in self.failed_links_:
+            shutil.copyfile(source, path)
+        elif mode == "hardlink":
+            self.hardlink(source, path)
+        elif mode == "reflink":
+            self.reflink(source, path)
+        elif mode == "symlink":
+            os.symlink(source, path)
+        else:
+            shutil.copyfile(source, path)
+
+    def hardlink(self, source, path):
+        try:
+            os.link(source, path)
+        except OSError as e:
+            # blob store on a different filesystem, or links not supported
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+
+            self.link_failed("hardlink", e)
+            shutil.copyfile(source, path)
+
+    def reflink(self, source, path):
+        if fcntl is None:
+            self.link_failed("reflink", "not supported on this platform")
+            shutil.copyfile(source, path)
+            return
+
+        with open(source, "rb") as s, open(path, "wb") as d:
+            try:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+                return
+            except OSError as e:
+                self.link_failed("reflink", e)
+
+        shutil.copyfile(source, path)
+
+    def link_failed(self, mode, e):
+        if mode not in self.failed_links_:
+            self.failed_links_.add(mode)
+            warn("{} failed ({}), copying files instead", mode, e)
+
+    def writers(self):
+        if self.writers_ is None:
+            import concurrent.futures
+            self.writers_ = concurrent.futures.ThreadPoolExecutor(
+                max_workers=WRITE_THREADS)
+
+        return self.writers_
+
+    def dir_fd(self, dir):
+        fd = self.dir_fds_.get(dir)
+
+        if fd is None:
+            if len(self.dir_fds_) >= MAX_DIR_FDS:
+                self.close_dir_fds()
+
+            fd = os.open(dir, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+            self.dir_fds_[dir] = fd
+
+        return fd
+
+    def close_dir_fds(self):
+        for fd in self.dir_fds_.values():
+            os.close(fd)
+
+        self.dir_fds_ = {}
+
     def delete_file(self, path):
         os.remove(path)
 
+    def remove_empty_directory(self, path):
+        try:
+            os.rmdir(path)
+            return True
+        except OSError:
+            return False
+
     def temp_file(self):
         f = tempfile.mkstemp()
         os.close(f[0])
         return f[1]
 
-    def run_process(self, args, cwd):
-        subprocess.run(args, cwd=cwd)
+    def set_archiver(self, archiver):
+        self.archiver_ = archiver
+
+    def archive(self, input, output, exclude=[]):
+        if os.path.exists(output):
+            raise Exception("file {} already exists".format(output))
+
+        self.archiver_.archive(input, output, exclude)
+
+    def archive_string(self, path, content):
+        return self.archiver_.archive_string(path, content)
+
+    def write_archives(self, files):
+        # archives are mostly waiting on 7z or zlib, which both release the
+        # gil, so up to archive_jobs of them are created at the same time,
+        # each streaming to its own file
+        if self.archive_jobs_ <= 1 or len(files) <= 1:
+            for path, content in files:
+                self.write_file_path(path, content)
+
+            return
+
+        list(self.archive_threads().map(
+            lambda f: self.write_file_path(f[0], f[1]), files))
+
+    def archive_files(self, listfile, output, cwd):
+        if os.path.exists(output):
+            raise Exception("file {} already exists".format(output))
+
+        self.archiver_.archive_files(listfile, output, cwd)
+
+    def archive_threads(self):
+        if self.archive_threads_ is None:
+            import concurrent.futures
+            self.archive_threads_ = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.archive_jobs_)
+
+        return self.archive_threads_
+
+
+class AsyncOperations(RealOperations):
+    # runs the operations of the async path of Context on an executor, with a
+    # limit on the number of operations in flight across all batches, so
+    # directories, files and archives from different batches overlap; the
+    # blocking batch operations go through the same path; asyncio is only
+    # imported by these methods, it's slow to import and only used by --async
+
+    def __init__(self, wait_for_trash=True, archive_jobs=1, limit=64):
+        super().__init__(wait_for_trash, archive_jobs)
+        self.limit_ = limit
+
+        # created on demand, the semaphore belongs to the running event loop
+        self.io_ = None
+        self.semaphore_ = None
+        self.loop_ = None
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state["io_"] = None
+        state["semaphore_"] = None
+        state["loop_"] = None
+        return state
+
+    def close(self):
+        if self.io_ is not None:
+            self.io_.shutdown()
+            self.io_ = None
+
+        super().close()
+
+    def write_files(self, files):
+        import asyncio
+        asyncio.run(self.write_files_async(files))
+
+    def write_archives(self, files):
+        import asyncio
+        asyncio.run(self.write_archives_async(files))
+
+    async def create_directory_async(self, path):
+        await self.run(self.create_directory, path)
+
+    async def write_files_async(self, files):
+        # same chunks as write_files(), one operation each
+        import asyncio
+        await asyncio.gather(
+            *(self.run(self.write_chunk, c) for c in self.write_chunks(files)))
+
+    async def write_archives_async(self, files):
+        # one operation per archive, streamed by the archiver in an executor
+        # thread that mostly waits on 7z or zlib
+        import asyncio
+        await asyncio.gather(
+            *(self.run(self.write_file_path, p, c) for p, c in files))
+
+    async def run(self, f, *args):
+        import asyncio
+
+        async with self.semaphore():
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.io(), f, *args)
+
+    def semaphore(self):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+
+        if self.loop_ is not loop:
+            self.loop_ = loop
+            self.semaphore_ = asyncio.Semaphore(self.limit_)
 
-    def popen(self, args, send):
-        p = subprocess.Popen(
-            args, stdout=subprocess.PIPE, stdin=subprocess.PIPE)
+        return self.semaphore_
 
-        out, err = p.communicate(send)
-        if err is not None:
-            error(err)
+    def io(self):
+        if self.io_ is None:
+            import concurrent.futures
+            self.io_ = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.limit_)
 
-        return out
+        return self.io_
@@ -0,0 +1,279 @@
+import os
+import abc
+import random
+import argparse
+
+# numpy is optional and slow to import, it's only imported by the first
+# Sampler, see load_numpy()
+numpy = None
+numpy_loaded = False
+
+STRATEGIES = ["pattern", "sparse", "fallocate"]
+
+# pattern data is written from this buffer, over and over if necessary
+PATTERN = bytes(range(256)) * 4096
+
+# number of sizes drawn at once by sample_sizes()
+SIZE_BATCH = 4096
+
+# suffixes accepted by parse_size()
+SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+class StreamedContent(metaclass=abc.ABCMeta):
+    # content that writes itself to a file descriptor instead of being held
+    # in memory; len() is the size used for stats and the manifest and
+    # description() is hashed instead of the actual data
+
+    @abc.abstractmethod
+    def __len__(self):
+        pass
+
+    @abc.abstractmethod
+    def description(self):
+        pass
+
+    @abc.abstractmethod
+    def write_to(self, fd):
+        pass
+
+
+class SizedContent(StreamedContent):
+    # content of a file that only has a size, written with one of these
+    # strategies:
+    #   pattern:   actual data, written from one reusable buffer
+    #   sparse:    the file is truncated to the size, nothing is written
+    #   fallocate: like sparse, but the space is preallocated when the
+    #              platform supports it
+
+    def __init__(self, size, strategy="pattern"):
+        self.size_ = size
+        self.strategy_ = strategy
+
+    def __len__(self):
+        return self.size_
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, SizedContent) and
+            self.size_ == other.size_ and
+            self.strategy_ == other.strategy_)
+
+    def __hash__(self):
+        return hash((self.size_, self.strategy_))
+
+    def size(self):
+        return self.size_
+
+    def strategy(self):
+        return self.strategy_
+
+    def description(self):
+        # used instead of the actual data for hashing
+        return "sized:{}:{}".format(self.strategy_, self.size_)
+
+    def data(self):
+        # the actual bytes, for when the content has to go through memory
+        # anyway, like when archiving
+        if self.size_ <= len(PATTERN):
+            return PATTERN[:self.size_]
+
+        return (PATTERN * (self.size_ // len(PATTERN) + 1))[:self.size_]
+
+    def chunks(self):
+        # the same bytes as data(), but in pieces that are at most the size of
+        # the pattern
+        view = memoryview(PATTERN)
+        left = self.size_
+
+        while left > 0:
+            chunk = view[:min(left, len(view))]
+            left -= len(chunk)
+            yield chunk
+
+    def write_to(self, fd):
+        if self.strategy_ == "sparse":
+            os.ftruncate(fd, self.size_)
+        elif self.strategy_ == "fallocate" and hasattr(os, "posix_fallocate"):
+            if self.size_ > 0:
+                os.posix_fallocate(fd, 0, self.size_)
+        elif self.strategy_ == "fallocate":
+            # windows, extending the file allocates it anyway
+            os.ftruncate(fd, self.size_)
+        else:
+            self.write_pattern(fd)
+
+    def write_pattern(self, fd):
+        for chunk in self.chunks():
+            while len(chunk) > 0:
+                chunk = chunk[os.write(fd, chunk):]
+
+
+def load_numpy():
+    global numpy, numpy_loaded
+
+    if numpy_loaded:
+        return
+
+    numpy_loaded = True
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+
+class Sampler:
+    # random values for a whole population at once, with numpy when
+    # available; sequences returned by numpy are arrays, lists otherwise
+
+    def __init__(self, seed):
+        load_numpy()
+
+        if numpy is None:
+            self.random_ = random.Random(seed)
+        else:
+            self.rng_ = numpy.random.default_rng(seed)
+
+    def __setstate__(self, state):
+        # a sampler unpickled in a spawned process uses numpy if it was
+        # created with it
+        load_numpy()
+        self.__dict__.update(state)
+
+    def sizes(self, spec, n):
+        # spec is either a number or a dict with a "distribution" of
+        # "uniform" (min, max) or "lognormal" (mean, sigma, of the underlying
+        # normal distribution) and an optional "max"
+        if isinstance(spec, int):
+            return [spec] * n
+
+        if not isinstance(spec, dict):
+            raise ValueError("bad size '{}'".format(spec))
+
+        d = spec.get("distribution")
+
+        if d == "uniform":
+            lo, hi = spec["min"], spec["max"]
+
+            if numpy is None:
+                s = [self.random_.randint(lo, hi) for i in range(n)]
+            else:
+                s = self.rng_.integers(lo, hi, n, endpoint=True)
+        elif d == "lognormal":
+            mean, sigma = spec["mean"], spec["sigma"]
+
+            if numpy is None:
+                s = [int(self.random_.lognormvariate(mean, sigma))
+                     for i in range(n)]
+            else:
+                s = self.rng_.lognormal(mean, sigma, n).astype(numpy.int64)
+        else:
+            raise ValueError("bad size distribution '{}'".format(d))
+
+        if "max" in spec:
+            if numpy is None:
+                s = [min(v, spec["max"]) for v in s]
+            else:
+                s = numpy.minimum(s, spec["max"])
+
+        return s
+
+    def integer(self, n):
+        # a single value from range(n)
+        if numpy is None:
+            return self.random_.randrange(n)
+        else:
+            return int(self.rng_.integers(n))
+
+    def choice(self, population, k):
+        # k distinct values from range(population)
+        if numpy is None:
+            return self.random_.sample(range(population), k)
+        else:
+            return self.rng_.choice(population, k, replace=False)
+
+    def mask(self, n, fraction):
+        # n booleans, each true with the given probability
+        if fraction <= 0:
+            return None
+
+        if numpy is None:
+            return [self.random_.random() < fraction for i in range(n)]
+        else:
+            return self.rng_.random(n) < fraction
+
+
+def sample_sizes(sampler, spec):
+    # endless generator of sizes, drawn in batches
+    while True:
+        for s in sampler.sizes(spec, SIZE_BATCH):
+            yield int(s)
+
+def make_sizes(opts, seed):
+    # generator of sizes from --size, None if it wasn't given
+    if opts.size is None:
+        return None
+
+    return sample_sizes(Sampler(seed), opts.size)
+
+def sized_content(opts, sizes):
+    return SizedContent(next(sizes), opts.size_strategy)
+
+def parse_size(s):
+    # "123", "4K", "10M", "1G"
+    s = s.strip().upper()
+    unit = ""
+
+    if len(s) > 0 and s[-1] in SIZE_UNITS:
+        unit = s[-1]
+        s = s[:-1]
+
+    try:
+        return int(s) * SIZE_UNITS[unit]
+    except ValueError:
+        raise argparse.ArgumentTypeError("bad size '{}'".format(s + unit))
+
+def parse_size_spec(s):
+    # used as the argparse type for --size, returns a spec for
+    # Sampler.sizes():
+    #   "SIZE":                  constant size
+    #   "MIN-MAX":               uniform distribution
+    #   "lognormal:MEAN:SIGMA":  lognormal distribution of the underlying
+    #                            normal's mean and sigma
+    if s.startswith("lognormal:"):
+        try:
+            _, mean, sigma = s.split(":")
+            return {
+                "distribution": "lognormal",
+                "mean": float(mean),
+                "sigma": float(sigma)}
+        except ValueError:
+            raise argparse.ArgumentTypeError("bad size '{}'".format(s))
+
+    if "-" in s:
+        lo, hi = s.split("-", 1)
+        return {
+            "distribution": "uniform",
+            "min": parse_size(lo),
+            "max": parse_size(hi)}
+
+    return parse_size(s)
+
+def add_size_arguments(p, what):
+    p.add_argument(
+        "--size",
+        type=parse_size_spec,
+        default=None,
+        help="size of " + what + ": SIZE, MIN-MAX for a uniform " +
+             "distribution or lognormal:MEAN:SIGMA; sizes accept K, M and G " +
+             "suffixes")
+
+    p.add_argument(
+        "--size-strategy",
+        type=str,
+        choices=STRATEGIES,
+        default="pattern",
+        help="how sized files are created: 'pattern' writes actual data, " +
+             "'sparse' creates sparse files and 'fallocate' preallocates " +
+             "them, defaults to 'pattern'")
@@ -0,0 +1,202 @@
+import os
+import time
+import shutil
+import tempfile
+from .operations import RealOperations
+from .log import *
+
+# calibration writes these in a temporary directory of the target filesystem
+# to measure how fast it is: directories, small files spread over them and one
+# big file, each timed separately
+CALIBRATION_DIRS = 20
+CALIBRATION_FILES = 50
+CALIBRATION_FILE_SIZE = 1024
+CALIBRATION_BIG_SIZE = 32 * 1024 * 1024
+
+
+def count_entries(path):
+    # number of files and directories under path, iteratively; 0 if it
+    # doesn't exist
+    count = 0
+    stack = [path]
+
+    while len(stack) > 0:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for e in it:
+                    count += 1
+                    if e.is_dir(follow_symlinks=False):
+                        stack.append(e.path)
+        except FileNotFoundError:
+            pass
+
+    return count
+
+def calibration_directory(path):
+    # where the calibration files are written for a target directory: the
+    # temporary directory if it's on the same filesystem, or the parent of
+    # the target, so nothing is left in the target if the run is interrupted;
+    # the target itself only if it's the root of its filesystem
+    device = os.stat(path).st_dev
+    temp = tempfile.gettempdir()
+
+    try:
+        if os.stat(temp).st_dev == device:
+            return temp
+    except OSError:
+        pass
+
+    if os.path.ismount(path):
+        return path
+
+    return os.path.dirname(path)
+
+def existing_parent(path):
+    # the path itself or its closest parent that exists, used for the
+    # filesystem checks on directories that may not have been created yet
+    path = os.path.abspath(path)
+
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
+    return path
+
+
+class Throughput:
+    # operations per second of a filesystem, see measure()
+
+    def __init__(self, directories, files, bytes):
+        self.directories = directories
+        self.files = files
+        self.bytes = bytes
+
+    @staticmethod
+    def measure(path):
+        # writes the calibration files in a temporary directory on the same
+        # filesystem as path, see calibration_directory(), with the same
+        # operations used by the generators, then deletes them
+        temp = tempfile.mkdtemp(
+            prefix="modutils-calibration-", dir=calibration_directory(path))
+        ops = RealOperations()
+
+        try:
+            dirs = [os.path.join(temp, str(i)) for i in range(CALIBRATION_DIRS)]
+
+            start = time.perf_counter()
+            for d in dirs:
+                ops.create_directory(d)
+            dirs_time = time.perf_counter() - start
+
+            content = "x" * CALIBRATION_FILE_SIZE
+            files = []
+            for d in dirs:
+                for i in range(CALIBRATION_FILES):
+                    files.append((os.path.join(d, str(i)), content))
+
+            start = time.perf_counter()
+            ops.write_files(files)
+            files_time = time.perf_counter() - start
+
+            big = bytes(CALIBRATION_BIG_SIZE)
+
+            start = time.perf_counter()
+            ops.write_file(os.path.join(temp, "big"), big)
+            big_time = time.perf_counter() - start
+        finally:
+            ops.close()
+            shutil.rmtree(temp, ignore_errors=True)
+
+        return Throughput(
+            len(dirs) / max(dirs_time, 1e-9),
+            len(files) / max(files_time, 1e-9),
+            len(big) / max(big_time, 1e-9))
+
+    def duration(self, stats):
+        # seconds to create what's in the given Stats, sequentially; the
+        # bytes of small files are already in the time per file
+        return (
+            stats.directories / self.directories +
+            stats.files / self.files +
+            stats.bytes / self.bytes)
+
+
+class Plan:
+    # what a dry run would have done, from the stats of its context, checked
+    # against the filesystem that would have been written to
+
+    def __init__(self, stats, path):
+        self.stats_ = stats
+        self.path_ = existing_parent(path)
+
+    def path(self):
+        return self.path_
+
+    def problems(self):
+        # returns a list of strings, empty if there is enough free space and
+        # inodes; space used by cleared directories isn't counted as free
+        # because they're deleted in the background while files are written
+        problems = []
+
+        usage = shutil.disk_usage(self.path_)
+        if self.stats_.bytes > usage.free:
+            problems.append("not enough free space on {}: {} needed, {} free".format(
+                self.path_, byte_size_string(self.stats_.bytes),
+                byte_size_string(usage.free)))
+
+        inodes = self.inodes_free()
+        needed = self.stats_.files + self.stats_.directories
+
+        if inodes is not None and needed > inodes:
+            problems.append("not enough free inodes on {}: {} needed, {} free".format(
+                self.path_, needed, inodes))
+
+        return problems
+
+    def inodes_free(self):
+        # None if unknown, like on windows or filesystems that allocate
+        # inodes dynamically and report 0
+        if not hasattr(os, "statvfs"):
+            return None
+
+        st = os.statvfs(self.path_)
+        if st.f_files == 0:
+            return None
+
+        return st.f_favail
+
+    def log(self, throughput=None):
+        usage = shutil.disk_usage(self.path_)
+        inodes = self.inodes_free()
+
+        rows = [
+            ("files", self.stats_.files),
+            ("directories", self.stats_.directories),
+            ("bytes", byte_size_string(self.stats_.bytes)),
+            ("archive jobs", self.stats_.archives),
+            ("cleared entries", self.stats_.cleared),
+            ("free space", byte_size_string(usage.free)),
+            ("free inodes", "?" if inodes is None else inodes)]
+
+        if self.stats_.unchanged > 0:
+            rows.insert(3, ("unchanged files", self.stats_.unchanged))
+
+        if throughput is not None:
+            rows.append(("projected time", "{:.1f}s".format(
+                throughput.duration(self.stats_))))
+
+            rows.append(("measured", "{:.0f} dirs/s, {:.0f} files/s, {}/s".format(
+                throughput.directories, throughput.files,
+                byte_size_string(throughput.bytes))))
+
+        info("plan for {}:", self.path_)
+        info(make_table(rows))
+
+        problems = self.problems()
+        for p in problems:
+            warn(p)
+
+        return len(problems) == 0
+
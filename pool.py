@@ -0,0 +1,79 @@
+import concurrent.futures
+import itertools
+import pickle
+from . import log
+
+# context used by jobs running in a worker process, set once per process by
+# init_worker()
+worker_cx = None
+
+def init_worker(state, level):
+    global worker_cx
+
+    # the log level is a global, it isn't inherited by spawned processes
+    log.set_log_level(level)
+
+    # the context is always unpickled, even when the process is forked: the
+    # parent may already have threads and handles (writers, trash, directory
+    # handles) that must not be shared, and __getstate__() drops them
+    worker_cx = pickle.loads(state)
+
+def run_job(f, item):
+    # stats and the files created are reset for every job and sent back with
+    # the result so the parent process can merge them into its own
+    worker_cx.reset_job()
+    r = f(worker_cx, item)
+
+    # workers exit without running atexit handlers, buffered lines would be
+    # lost
+    log.flush_log()
+
+    return r, worker_cx.job_results()
+
+
+class Pool:
+    def __init__(self, cx):
+        self.cx_ = cx
+        self.executor_ = None
+
+    def jobs(self):
+        return self.cx_.options.jobs
+
+    def map(self, f, items):
+        # calls f(cx, item) for each item and returns the results in order
+        #
+        # with more than one job, f and items are sent to worker processes, so
+        # they must be picklable: module-level functions or methods of command
+        # objects, and no generators
+        items = list(items)
+
+        if self.jobs() <= 1 or len(items) <= 1:
+            return [f(self.cx_, i) for i in items]
+
+        # a few chunks per worker to amortize the pickling costs while still
+        # balancing the load
+        chunksize = max(1, len(items) // (self.jobs() * 4))
+
+        results = []
+        rs = self.executor().map(
+            run_job, itertools.repeat(f), items, chunksize=chunksize)
+
+        for r, job_results in rs:
+            self.cx_.merge_job_results(job_results)
+            results.append(r)
+
+        return results
+
+    def executor(self):
+        if self.executor_ is None:
+            self.executor_ = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.jobs(),
+                initializer=init_worker,
+                initargs=(pickle.dumps(self.cx_), log.log_level))
+
+        return self.executor_
+
+    def close(self):
+        if self.executor_ is not None:
+            self.executor_.shutdown()
+            self.executor_ = None
@@ -0,0 +1,247 @@
+import json
+import time
+import threading
+from .operations import OperationsImpl
+from .log import *
+
+# latencies are counted in buckets of powers of two, in microseconds: bucket i
+# has the operations that took less than 2^i us, the last one has the rest
+HISTOGRAM_BUCKETS = 32
+
+
+class OperationStats:
+    def __init__(self):
+        self.calls = 0
+        self.items = 0
+        self.bytes = 0
+        self.time = 0.0
+        self.max = 0.0
+        self.histogram = [0] * HISTOGRAM_BUCKETS
+
+    def record(self, items, size, elapsed):
+        self.calls += 1
+        self.items += items
+        self.bytes += size
+        self.time += elapsed
+        self.max = max(self.max, elapsed)
+
+        us = int(elapsed * 1000000)
+        self.histogram[min(us.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+
+    def add(self, other):
+        self.calls += other.calls
+        self.items += other.items
+        self.bytes += other.bytes
+        self.time += other.time
+        self.max = max(self.max, other.max)
+
+        for i in range(HISTOGRAM_BUCKETS):
+            self.histogram[i] += other.histogram[i]
+
+    def to_json(self):
+        # only buckets that have something, keyed by their upper bound
+        histogram = {}
+        for i, n in enumerate(self.histogram):
+            if n > 0:
+                histogram["<" + latency_string(2 ** i / 1000000)] = n
+
+        return {
+            "calls": self.calls,
+            "items": self.items,
+            "bytes": self.bytes,
+            "time": self.time,
+            "max": self.max,
+            "histogram": histogram}
+
+
+class Profile:
+    # operation name -> OperationStats; worker processes send theirs back with
+    # the job results, see Context.job_results()
+
+    def __init__(self):
+        self.ops_ = {}
+        self.lock_ = threading.Lock()
+        self.start_ = time.perf_counter()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["lock_"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock_ = threading.Lock()
+
+    def record(self, name, items, size, elapsed):
+        with self.lock_:
+            s = self.ops_.get(name)
+            if s is None:
+                s = OperationStats()
+                self.ops_[name] = s
+
+            s.record(items, size, elapsed)
+
+    def take(self):
+        with self.lock_:
+            ops = self.ops_
+            self.ops_ = {}
+            return ops
+
+    def merge(self, ops):
+        with self.lock_:
+            for name, other in ops.items():
+                s = self.ops_.get(name)
+                if s is None:
+                    self.ops_[name] = other
+                else:
+                    s.add(other)
+
+    def to_json(self, opts):
+        ops = {}
+        for name in sorted(self.ops_):
+            ops[name] = self.ops_[name].to_json()
+
+        return json.dumps({
+            "command": opts.command,
+            "arguments": vars(opts),
+            "wall": time.perf_counter() - self.start_,
+            "operations": ops}, indent=2, default=str)
+
+    def table(self):
+        rows = []
+        for name in sorted(self.ops_, key=lambda n: -self.ops_[n].time):
+            s = self.ops_[name]
+            rows.append((name, "{} calls, {} items, {}, {}".format(
+                s.calls, s.items, byte_size_string(s.bytes),
+                latency_string(s.time))))
+
+        return make_table(rows)
+
+    def write(self, path, opts):
+        with open(path, "w") as f:
+            f.write(self.to_json(opts))
+
+
+def latency_string(seconds):
+    if seconds < 0.001:
+        return "{:.0f}us".format(seconds * 1000000)
+    elif seconds < 1:
+        return "{:.1f}ms".format(seconds * 1000)
+    else:
+        return "{:.2f}s".format(seconds)
+
+
+class ProfiledOperations(OperationsImpl):
+    # forwards everything to another OperationsImpl and records how long each
+    # operation took, with the number of files and bytes involved
+
+    def __init__(self, ops, profile):
+        self.ops_ = ops
+        self.profile_ = profile
+
+    def timed(self, name, items, size, f, *args):
+        start = time.perf_counter()
+
+        try:
+            return f(*args)
+        finally:
+            self.profile_.record(
+                name, items, size, time.perf_counter() - start)
+
+    async def timed_async(self, name, items, size, f, *args):
+        start = time.perf_counter()
+
+        try:
+            return await f(*args)
+        finally:
+            self.profile_.record(
+                name, items, size, time.perf_counter() - start)
+
+    def clear_directory(self, path):
+        self.timed("clear_directory", 1, 0, self.ops_.clear_directory, path)
+
+    def create_directory(self, path):
+        self.timed("create_directory", 1, 0, self.ops_.create_directory, path)
+
+    def write_file(self, path, content):
+        self.timed(
+            "write_file", 1, len(content), self.ops_.write_file, path, content)
+
+    def write_files(self, files):
+        self.timed(
+            "write_files", len(files), files_size(files),
+            self.ops_.write_files, files)
+
+    def write_file_atomic(self, path, content):
+        self.timed(
+            "write_file_atomic", 1, len(content),
+            self.ops_.write_file_atomic, path, content)
+
+    def append_file(self, path, content):
+        self.timed(
+            "append_file", 1, len(content), self.ops_.append_file, path, content)
+
+    def write_archives(self, files):
+        self.timed(
+            "write_archives", len(files), files_size(files),
+            self.ops_.write_archives, files)
+
+    async def create_directory_async(self, path):
+        await self.timed_async(
+            "create_directory", 1, 0, self.ops_.create_directory_async, path)
+
+    async def write_files_async(self, files):
+        await self.timed_async(
+            "write_files", len(files), files_size(files),
+            self.ops_.write_files_async, files)
+
+    async def write_archives_async(self, files):
+        await self.timed_async(
+            "write_archives", len(files), files_size(files),
+            self.ops_.write_archives_async, files)
+
+    def link_file(self, source, path, mode):
+        self.timed("link_file", 1, 0, self.ops_.link_file, source, path, mode)
+
+    def link_files(self, links, mode):
+        self.timed(
+            "link_files", len(links), 0, self.ops_.link_files, links, mode)
+
+    def delete_file(self, path):
+        self.timed("delete_file", 1, 0, self.ops_.delete_file, path)
+
+    def remove_empty_directory(self, path):
+        return self.timed(
+            "remove_empty_directory", 1, 0,
+            self.ops_.remove_empty_directory, path)
+
+    def temp_file(self):
+        return self.timed("temp_file", 1, 0, self.ops_.temp_file)
+
+    def close(self):
+        # includes waiting for the trash
+        self.timed("close", 0, 0, self.ops_.close)
+
+    def set_archiver(self, archiver):
+        self.ops_.set_archiver(archiver)
+
+    def archive(self, input, output, exclude=[]):
+        self.timed("archive", 1, 0, self.ops_.archive, input, output, exclude)
+
+    def archive_string(self, path, content):
+        return self.timed(
+            "archive_string", 1, len(content),
+            self.ops_.archive_string, path, content)
+
+    def archive_files(self, listfile, output, cwd):
+        self.timed(
+            "archive_files", 1, 0,
+            self.ops_.archive_files, listfile, output, cwd)
+
+
+def files_size(files):
+    size = 0
+    for path, content in files:
+        size += len(content)
+
+    return size
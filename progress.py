@@ -0,0 +1,75 @@
+import sys
+import time
+import threading
+from .log import *
+
+# seconds between updates of the progress line
+PROGRESS_INTERVAL = 0.5
+
+
+def duration_string(seconds):
+    seconds = int(seconds)
+
+    if seconds < 60:
+        return "{}s".format(seconds)
+    elif seconds < 3600:
+        return "{}m{:02}s".format(seconds // 60, seconds % 60)
+
+    return "{}h{:02}m".format(seconds // 3600, (seconds % 3600) // 60)
+
+
+class Progress:
+    # one status line with the files and bytes written so far, their rates
+    # and an eta; a background thread reads the stats of the context at a
+    # fixed interval, so nothing is done per operation
+
+    def __init__(self, cx):
+        self.cx_ = cx
+        self.expected_ = None
+        self.start_ = None
+        self.stop_ = threading.Event()
+        self.thread_ = None
+
+    @staticmethod
+    def supported():
+        # the line is redrawn in place, which only works on terminals
+        return sys.stdout.isatty()
+
+    def expect(self, files):
+        # total number of files the command will write, for the eta
+        self.expected_ = files
+
+    def start(self):
+        self.start_ = time.perf_counter()
+        self.thread_ = threading.Thread(target=self.run, daemon=True)
+        self.thread_.start()
+
+    def stop(self):
+        if self.thread_ is None:
+            return
+
+        self.stop_.set()
+        self.thread_.join()
+        self.thread_ = None
+
+        set_status(None)
+
+    def run(self):
+        while not self.stop_.wait(PROGRESS_INTERVAL):
+            set_status(self.line())
+
+    def line(self):
+        stats = self.cx_.stats()
+        files = stats.files + stats.unchanged
+        elapsed = max(time.perf_counter() - self.start_, 1e-9)
+        rate = files / elapsed
+
+        s = "{} files, {}, {:.0f} files/s, {}/s".format(
+            files, byte_size_string(stats.bytes), rate,
+            byte_size_string(stats.bytes / elapsed))
+
+        if self.expected_ is not None and rate > 0:
+            left = max(0, self.expected_ - files)
+            s += ", eta " + duration_string(left / rate)
+
+        return s
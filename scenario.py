@@ -0,0 +1,251 @@
+import os
+import json
+import time
+from .mod import Mod, File
+from .payload import Sampler, SizedContent, STRATEGIES
+from .log import *
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import tomllib
+except ImportError:
+    # python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+# default values for each population in a scenario file
+POPULATION_DEFAULTS = {
+    "count": 1,             # number of mods
+    "name": "mod-{}",       # mod name, {} is the mod number
+    "files": 10,            # files per mod
+    "fanout": 1,            # subdirectories per directory
+    "depth": 0,             # depth of the directory tree in each mod
+    "file_name": "{}",      # file name, {} is the file number
+    "extensions": ["txt"],  # extensions, used in turn
+    "size": 16,             # size in bytes, or a distribution, see sizes()
+    "strategy": "pattern",  # how files are written, see SizedContent
+    "overlap": 0.0,         # fraction of files also in the previous mod
+    "hidden": 0.0           # fraction of files ending in .mohidden
+}
+
+class ScenarioError(Exception):
+    pass
+
+
+class ModPlan:
+    # files of one mod: file numbers and sizes, names are only built when the
+    # mod is created; this is what is sent to worker processes
+
+    def __init__(self, name, population, numbers, sizes, hidden):
+        self.name_ = name
+        self.population_ = population
+        self.numbers_ = numbers
+        self.sizes_ = sizes
+        self.hidden_ = hidden
+
+    def name(self):
+        return self.name_
+
+    def file_count(self):
+        return len(self.numbers_)
+
+    def total_size(self):
+        if numpy is not None and isinstance(self.sizes_, numpy.ndarray):
+            return int(self.sizes_.sum())
+
+        return sum(self.sizes_)
+
+    def files(self):
+        p = self.population_
+        exts = p["extensions"]
+        leaves = p["fanout"] ** p["depth"]
+
+        for i in range(len(self.numbers_)):
+            n = int(self.numbers_[i])
+
+            name = (
+                self.directory(n % leaves) +
+                p["file_name"].format(n + 1) + "." + exts[n % len(exts)])
+
+            if self.hidden_ is not None and self.hidden_[i]:
+                name += ".mohidden"
+
+            content = SizedContent(int(self.sizes_[i]), p["strategy"])
+            yield File(name, content)
+
+    def directory(self, leaf):
+        # leaf directories are numbered in base fanout, one digit per level
+        p = self.population_
+        s = ""
+
+        for d in range(p["depth"]):
+            s += "d" + str(leaf % p["fanout"]) + "/"
+            leaf //= p["fanout"]
+
+        return s
+
+
+def load_scenario(path):
+    ext = os.path.splitext(path)[1].lower()
+
+    try:
+        if ext == ".toml":
+            if tomllib is None:
+                raise ScenarioError(
+                    "toml files need python 3.11 or the tomli package")
+
+            with open(path, "rb") as f:
+                return tomllib.load(f)
+        else:
+            with open(path, "r") as f:
+                return json.load(f)
+    except (OSError, ValueError) as e:
+        raise ScenarioError("can't read '{}': {}".format(path, e))
+
+def compile_scenario(spec):
+    # returns a list of ModPlan
+    populations = spec.get("populations")
+    if not isinstance(populations, list) or len(populations) == 0:
+        raise ScenarioError("scenario has no populations")
+
+    sampler = Sampler(spec.get("seed", 0))
+    plans = []
+
+    for pspec in populations:
+        unknown = set(pspec.keys()) - set(POPULATION_DEFAULTS.keys())
+        if len(unknown) > 0:
+            raise ScenarioError(
+                "unknown population keys: " + ", ".join(sorted(unknown)))
+
+        p = dict(POPULATION_DEFAULTS)
+        p.update(pspec)
+
+        validate_population(p)
+
+        try:
+            plans += compile_population(sampler, p)
+        except (ValueError, KeyError) as e:
+            raise ScenarioError("bad population: {}".format(e))
+
+    names = set()
+    for plan in plans:
+        if plan.name() in names:
+            raise ScenarioError(
+                "more than one mod named '{}', populations need different "
+                "names".format(plan.name()))
+
+        names.add(plan.name())
+
+    return plans
+
+def validate_population(p):
+    # checked before anything is cleared
+    for key, lowest in [("count", 0), ("files", 0), ("fanout", 1), ("depth", 0)]:
+        v = p[key]
+        if not isinstance(v, int) or isinstance(v, bool) or v < lowest:
+            raise ScenarioError("bad {} {}, must be an integer >= {}".format(
+                key, json.dumps(v), lowest))
+
+    for key in ["overlap", "hidden"]:
+        v = p[key]
+        if (not isinstance(v, (int, float)) or isinstance(v, bool) or
+            not 0 <= v <= 1):
+            raise ScenarioError("bad {} {}, must be between 0 and 1".format(
+                key, json.dumps(v)))
+
+    if not isinstance(p["extensions"], list) or len(p["extensions"]) == 0:
+        raise ScenarioError("extensions must be a non-empty list")
+
+    if p["strategy"] not in STRATEGIES:
+        raise ScenarioError("bad strategy '{}'".format(p["strategy"]))
+
+def compile_population(sampler, p):
+    count = p["count"]
+    files = p["files"]
+    overlap = int(files * p["overlap"])
+
+    plans = []
+    previous = None
+
+    for i in range(count):
+        # each mod has its own range of file numbers, but some of them are
+        # taken from the previous mod in the population so they conflict;
+        # these are the numbers the previous mod actually has, which already
+        # include some from the one before it
+        if overlap == 0:
+            numbers = range(i * files, (i + 1) * files)
+        elif numpy is None:
+            numbers = list(range(i * files, (i + 1) * files))
+        else:
+            numbers = numpy.arange(i * files, (i + 1) * files)
+
+        if i > 0 and overlap > 0:
+            shared = sampler.choice(files, overlap)
+
+            if numpy is None:
+                for k in shared:
+                    numbers[k] = previous[k]
+            else:
+                numbers[shared] = previous[shared]
+
+        previous = numbers
+
+        sizes = sampler.sizes(p["size"], files)
+        hidden = sampler.mask(files, p["hidden"])
+
+        # each population is numbered from 1
+        name = p["name"].format(i + 1)
+        plans.append(ModPlan(name, p, numbers, sizes, hidden))
+
+    return plans
+
+
+class Scenario:
+    def name(self):
+        return "scenario"
+
+    def create_parser(self, sp):
+        p = sp.add_parser(
+            self.name(),
+            help="creates mods described in a scenario file",
+            description="creates mods described in a json or toml scenario " +
+                        "file; see POPULATION_DEFAULTS in scenario.py for " +
+                        "the available keys in each population")
+
+        p.add_argument(
+            "file",
+            type=str,
+            help="path to the scenario file")
+
+        return p
+
+    def run(self, cx):
+        try:
+            start = time.time()
+            plans = compile_scenario(load_scenario(cx.options.file))
+            elapsed = time.time() - start
+        except ScenarioError as e:
+            error("{}", e)
+            return 1
+
+        files = sum(p.file_count() for p in plans)
+        size = sum(p.total_size() for p in plans)
+
+        info("planned {} mods, {} files, {} in {:.2f}s",
+            len(plans), files, byte_size_string(size), elapsed)
+
+        cx.clear_directory(cx.mods_directory())
+        cx.pool().map(self.create_mod, plans)
+
+        return 0
+
+    def create_mod(self, cx, plan):
+        m = Mod(plan.name())
+        m.add_source(plan.files())
+        m.create(cx)
@@ -1,4 +1,36 @@
-from .mod import Mod, File
+import os
+import string
+from .mod import MOD_META_CONTENT
+
+# number of files written by one job, directories of a level are split in
+# jobs of about this many files
+FILES_PER_JOB = 1000
+
+
+def letters(i):
+    # 0 -> "a", 25 -> "z", 26 -> "ba", etc.
+    s = ""
+
+    while True:
+        s = string.ascii_lowercase[i % 26] + s
+        i //= 26
+
+        if i == 0:
+            return s
+
+def directory_path(level, index, fanout):
+    # path of a directory at the given level, where index is in
+    # range(fanout ** level); each digit of index in base fanout is the child
+    # picked at each level, the name is repeated once per level, like "a/bb"
+    parts = []
+
+    for depth in range(level, 0, -1):
+        parts.append(letters(index % fanout) * depth)
+        index //= fanout
+
+    parts.reverse()
+    return "/".join(parts)
+
 
 class Tree:
     def name(self):
@@ -7,22 +39,90 @@ class Tree:
     def create_parser(self, sp):
         p = sp.add_parser(
             self.name(),
-            help="creates one mod with a varied file tree",
-            description="creates one mod with a varied file tree")
+            help="creates mods with a file tree",
+            description="creates mods with a tree of directories; each " +
+                        "directory has --files files and --fanout " +
+                        "subdirectories, down to --depth levels")
+
+        p.add_argument(
+            "--mods",
+            type=int,
+            default=1,
+            help="number of mods to create, defaults to 1")
+
+        p.add_argument(
+            "--depth",
+            type=int,
+            default=2,
+            help="number of levels below the root of each mod, defaults to 2")
+
+        p.add_argument(
+            "--fanout",
+            type=int,
+            default=2,
+            help="number of subdirectories in each directory, defaults to 2")
+
+        p.add_argument(
+            "--files",
+            type=int,
+            default=3,
+            help="number of files in each directory, defaults to 3")
 
         return p
 
     def run(self, cx):
         cx.clear_directory(cx.mods_directory())
 
-        m = Mod("mod")
+        mods = [self.mod_name(i) for i in range(cx.options.mods)]
 
-        m.add_files(["1", "2", "3"])
-        m.add_files(["a/1", "a/2", "a/3"])
-        m.add_files(["a/aa/1", "a/aa/2", "a/aa/3"])
-        m.add_files(["b/1", "b/2", "b/3"])
-        m.add_files(["b/bb/1", "b/bb/2", "b/bb/3"])
+        # the tree is written breadth-first, one level at a time, so parent
+        # directories always exist; directories of a level are identified by
+        # their index, so jobs are just ranges and no level is ever kept in
+        # memory
+        fanout = cx.options.fanout
+        per_job = max(1, FILES_PER_JOB // max(1, cx.options.files))
 
-        m.create(cx)
+        directories = sum(fanout ** l for l in range(cx.options.depth + 1))
+        cx.expect_files(len(mods) * (directories * cx.options.files + 1))
+
+        for level in range(cx.options.depth + 1):
+            count = fanout ** level
+            jobs = []
+
+            for m in mods:
+                for first in range(0, count, per_job):
+                    jobs.append((m, level, first, min(count, first + per_job)))
+
+            cx.pool().map(self.create_directories, jobs)
 
         return 0
+
+    def mod_name(self, i):
+        if i == 0:
+            return "mod"
+
+        return "mod-" + str(i + 1)
+
+    def create_directories(self, cx, job):
+        name, level, first, last = job
+        root = os.path.join(cx.mods_directory(), name)
+
+        files = []
+
+        # the root is only in the first job of level 0, it gets the meta.ini
+        # every mod has, see Mod
+        if level == 0:
+            files.append((os.path.join(root, "meta.ini"), MOD_META_CONTENT))
+
+        for i in range(first, last):
+            dir = directory_path(level, i, cx.options.fanout)
+            path = os.path.join(root, dir)
+
+            cx.create_directory(path)
+
+            # like Mod.add_files(), the content is the file name
+            for f in range(cx.options.files):
+                rel = (dir + "/" if dir else "") + str(f + 1)
+                files.append((os.path.join(root, rel), rel))
+
+        cx.write_files(files)
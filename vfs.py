@@ -0,0 +1,267 @@
+import os
+import re
+import json
+import time
+import concurrent.futures
+from .conflict import ORACLE_FILENAME
+from .log import *
+
+# files in the root of a mod that are not part of the virtual tree
+IGNORED_ROOT_FILES = ["meta.ini"]
+
+HIDDEN_SUFFIX = ".mohidden"
+
+
+class TrieNode:
+    __slots__ = ["name", "dirs", "files"]
+
+    def __init__(self, name):
+        # name as it was first seen, lookups are case-insensitive
+        self.name = name
+
+        # lowercase name -> TrieNode
+        self.dirs = {}
+
+        # lowercase name -> (name, index of the winning mod, whether it's in
+        # more than one mod)
+        self.files = {}
+
+
+class Overlay:
+    # merged tree of all the mods, later mods overwrite earlier ones
+
+    def __init__(self, mods):
+        self.mods_ = mods
+        self.root_ = TrieNode("")
+        self.files_ = 0
+        self.dirs_ = 0
+        self.conflicts_ = 0
+        self.overwritten_ = [0] * len(mods)
+
+    def merge(self, index, listing):
+        # listing is what scan_mod() returned for the mod at the given index
+        for dir, files in listing:
+            node = self.root_
+
+            for part in dir:
+                key = part.lower()
+                child = node.dirs.get(key)
+
+                if child is None:
+                    child = TrieNode(part)
+                    node.dirs[key] = child
+                    self.dirs_ += 1
+
+                node = child
+
+            for name in files:
+                key = name.lower()
+                previous = node.files.get(key)
+
+                if previous is None:
+                    self.files_ += 1
+                    node.files[key] = (name, index, False)
+                    continue
+
+                # conflicts are paths in more than one mod, like the oracle
+                # of the conflict command, not the number of overwrites
+                if not previous[2]:
+                    self.conflicts_ += 1
+
+                self.overwritten_[previous[1]] += 1
+                node.files[key] = (name, index, True)
+
+    def file_count(self):
+        return self.files_
+
+    def dir_count(self):
+        return self.dirs_
+
+    def conflict_count(self):
+        return self.conflicts_
+
+    def overwritten(self):
+        # (mod name, number of its files overwritten by later mods)
+        return list(zip(self.mods_, self.overwritten_))
+
+    def winners(self):
+        # yields (path, mod name) for every file, iteratively
+        stack = [("", self.root_)]
+
+        while len(stack) > 0:
+            prefix, node = stack.pop()
+
+            for name, index, conflict in node.files.values():
+                yield prefix + name, self.mods_[index]
+
+            for child in node.dirs.values():
+                stack.append((prefix + child.name + "/", child))
+
+
+def scan_mod(path):
+    # returns a list of (directory parts, [file names]) for every directory in
+    # the mod, using an explicit stack instead of recursion
+    listing = []
+    stack = [()]
+
+    while len(stack) > 0:
+        parts = stack.pop()
+        files = []
+
+        with os.scandir(os.path.join(path, *parts)) as it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(parts + (e.name,))
+                elif e.name.endswith(HIDDEN_SUFFIX):
+                    continue
+                elif len(parts) == 0 and e.name in IGNORED_ROOT_FILES:
+                    continue
+                else:
+                    files.append(e.name)
+
+        listing.append((parts, files))
+
+    return listing
+
+def natural_key(s):
+    # "mod-2" before "mod-10"
+    return [int(p) if p.isdigit() else p.lower() for p in re.split(r"(\d+)", s)]
+
+def read_modlist(path):
+    # MO's modlist.txt: highest priority first, "+" for enabled mods, "-" for
+    # disabled mods and "*" for unmanaged ones; returns enabled mods, lowest
+    # priority first
+    mods = []
+
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("+"):
+                mods.append(line[1:])
+
+    mods.reverse()
+    return mods
+
+
+class Vfs:
+    def name(self):
+        return "vfs"
+
+    def create_parser(self, sp):
+        p = sp.add_parser(
+            self.name(),
+            help="builds the virtual file tree of the mods directory",
+            description="scans all the mods in priority order and merges " +
+                        "them in a tree that records which mod wins each " +
+                        "file; reports timings and conflicts")
+
+        p.add_argument(
+            "--modlist",
+            type=str,
+            default=None,
+            help="path to a modlist.txt for the priority order and enabled " +
+                 "mods, defaults to all mods sorted by name, with numbers " +
+                 "in natural order")
+
+        p.add_argument(
+            "--threads",
+            type=int,
+            default=os.cpu_count(),
+            help="number of threads scanning mods, defaults to the number " +
+                 "of cpus")
+
+        p.add_argument(
+            "--check",
+            action="store_true",
+            help="compares the winners with the oracle written by the " +
+                 "conflict command")
+
+        return p
+
+    def run(self, cx):
+        root = cx.mods_directory()
+        mods = []
+
+        for m in self.mod_order(cx):
+            if os.path.isdir(os.path.join(root, m)):
+                mods.append(m)
+            else:
+                warn("mod '{}' not found in {}, skipping", m, root)
+
+        start = time.time()
+
+        # scanning is parallel, but merging is done in priority order so the
+        # result doesn't depend on which mod finished scanning first
+        overlay = Overlay(mods)
+        paths = [os.path.join(root, m) for m in mods]
+
+        with concurrent.futures.ThreadPoolExecutor(cx.options.threads) as e:
+            for i, listing in enumerate(e.map(scan_mod, paths)):
+                overlay.merge(i, listing)
+
+        elapsed = time.time() - start
+        entries = overlay.file_count() + overlay.dir_count()
+
+        info(make_table([
+            ("mods", len(mods)),
+            ("files", overlay.file_count()),
+            ("directories", overlay.dir_count()),
+            ("conflicts", overlay.conflict_count()),
+            ("time", "{:.3f}s".format(elapsed)),
+            ("entries/s", "{:.0f}".format(entries / max(elapsed, 1e-9)))]))
+
+        overwritten = [o for o in overlay.overwritten() if o[1] > 0]
+        overwritten.sort(key=lambda o: o[1], reverse=True)
+
+        if len(overwritten) > 0:
+            info("\nmods with the most overwritten files:")
+            info(make_table(overwritten[:10]))
+
+        if cx.options.check:
+            return self.check(cx, overlay)
+
+        return 0
+
+    def mod_order(self, cx):
+        if cx.options.modlist is not None:
+            return read_modlist(cx.options.modlist)
+
+        mods = []
+        with os.scandir(cx.mods_directory()) as it:
+            for e in it:
+                if e.is_dir():
+                    mods.append(e.name)
+
+        return sorted(mods, key=natural_key)
+
+    def check(self, cx, overlay):
+        path = os.path.join(cx.instance_directory(), ORACLE_FILENAME)
+
+        try:
+            with open(path, "r") as f:
+                expected = json.load(f)["winners"]
+        except (OSError, ValueError, KeyError) as e:
+            error("can't read oracle {}: {}", path, e)
+            return 1
+
+        expected = {p.lower(): m for p, m in expected.items()}
+        bad = 0
+        seen = 0
+
+        for p, m in overlay.winners():
+            seen += 1
+            e = expected.get(p.lower())
+
+            if e != m:
+                bad += 1
+                if bad <= 10:
+                    error("{}: expected {}, got {}", p, e, m)
+
+        missing = len(expected) - (seen - bad)
+        if bad > 0 or missing > 0:
+            error("check failed, {} wrong winners, {} paths missing",
+                bad, max(missing, 0))
+            return 1
+
+        info("check ok, {} paths", seen)
+        return 0